@@ -1,54 +1,233 @@
-from hash_utils import hashMessage
-from state import isValid, updateState
+import itertools
+import json
+import multiprocessing
+from collections.abc import Sequence
+from datetime import datetime
+from blockstore import BlockStore
+from hash_utils import hashMessage, canonicalJson
+from merkle import merkleRoot, merkleRootFromHashes
+from state import isValid, StateOverlay
+from miner import SerialMiner
+from keys import verifySign
+from transaction import Transaction
+from user import public_key_index
 
-def makeBlock(blockChain, transactions, difficulty=2):
-    parentBlock = blockChain[-1]
-    parentBlockHash = parentBlock['hash']
+# Proof-of-work difficulty the server mines at
+MINING_DIFFICULTY = 3
+PARALLEL_MIN_BLOCKS = 64
+VERIFY_CHUNK_BLOCKS = 64
+
+def headerContent(blockContent):
+    """Block content without the transaction bodies; what the hash covers once the block has a merkleRoot"""
+    return {key: value for key, value in blockContent.items() if key != 'transactions'}
+
+def hashBlockContent(blockContent):
+    if 'merkleRoot' in blockContent:
+        return hashMessage(headerContent(blockContent))
+    return hashMessage(blockContent)
+
+def mineBlockContent(blockContent, difficulty=2, miner=None):
+    if miner is None:
+        miner = SerialMiner()
+    # Only the fixed-size header is hashed per nonce, so mining cost does not grow with the block
+    header = headerContent(blockContent)
+    blockHash = miner.mine(header, difficulty)
+    blockContent['nonce'] = header['nonce']
+    return {'hash': blockHash, 'content': blockContent}
+
+def makeGenesisBlock(transactions, difficulty=2, miner=None, timestamp=None):
+    blockContent = {
+        'index': 0,
+        'parentHash': None,
+        'transactionCount': len(transactions),
+        'merkleRoot': merkleRoot(transactions),
+        'transactions': transactions,
+        'nonce': 0
+    }
+    if timestamp is not None:
+        blockContent['timestamp'] = timestamp
+    return mineBlockContent(blockContent, difficulty, miner)
+
+def makeBlock(blockChain, transactions, difficulty=2, miner=None, timestamp=None, txids=None):
+    """txids, when given, are the transactions' hashes in order, so the merkle root needs no re-encoding"""
+    parentBlockHash = blockHashAt(blockChain, -1)
     blockContent = {
         'index': len(blockChain),
         'parentHash': parentBlockHash,
         'transactionCount': len(transactions),
+        'merkleRoot': merkleRoot(transactions) if txids is None else merkleRootFromHashes(txids),
         'transactions': transactions,
-        'nonce': 0
+        'nonce': 0,
+        'timestamp': timestamp if timestamp is not None else datetime.now().isoformat()
     }
-    
-    while True:
-        blockHash = hashMessage(blockContent)
-        if blockHash.startswith('0' * difficulty):
-            break
-        blockContent['nonce'] += 1
-    
-    return {'hash': blockHash, 'content': blockContent}
+
+    return mineBlockContent(blockContent, difficulty, miner)
+
+class BlockHeader:
+    """Block header fields in slots; merkleRoot and timestamp are None when the block has none"""
+    __slots__ = ('index', 'parentHash', 'transactionCount', 'merkleRoot', 'nonce', 'timestamp', 'hash', 'extra')
+    OPTIONAL_FIELDS = ('merkleRoot', 'timestamp')
+
+    def __init__(self, index, parentHash, transactionCount, nonce, hash, merkleRoot=None, timestamp=None,
+                 extra=None):
+        self.index = index
+        self.parentHash = parentHash
+        self.transactionCount = transactionCount
+        self.merkleRoot = merkleRoot
+        self.nonce = nonce
+        self.timestamp = timestamp
+        self.hash = hash
+        self.extra = extra
+
+    @classmethod
+    def fromDict(cls, block):
+        """From a block or blockHeader() dict"""
+        content = block['content']
+        known = ('index', 'parentHash', 'transactionCount', 'nonce', 'transactions', *cls.OPTIONAL_FIELDS)
+        extra = {
+            key: value for key, value in content.items()
+            if key not in known or (key in cls.OPTIONAL_FIELDS and value is None)
+        }
+        return cls(content['index'], content['parentHash'], content['transactionCount'], content['nonce'],
+                   block['hash'], content.get('merkleRoot'), content.get('timestamp'), extra or None)
+
+    def content(self):
+        content = {
+            'index': self.index,
+            'parentHash': self.parentHash,
+            'transactionCount': self.transactionCount,
+            'nonce': self.nonce
+        }
+        for key in self.OPTIONAL_FIELDS:
+            if getattr(self, key) is not None:
+                content[key] = getattr(self, key)
+        if self.extra:
+            content.update(self.extra)
+        return content
+
+    def toDict(self):
+        """Same shape as blockHeader()"""
+        return {'hash': self.hash, 'content': self.content()}
+
+class Block:
+    """A header plus a tuple of Transaction objects; toDict() gives back the stored block dict"""
+    __slots__ = ('header', 'transactions')
+
+    def __init__(self, header, transactions):
+        self.header = header
+        self.transactions = tuple(transactions)
+
+    @classmethod
+    def fromDict(cls, block):
+        transactions = (Transaction.fromDict(transaction) for transaction in block['content']['transactions'])
+        return cls(BlockHeader.fromDict(block), transactions)
+
+    def toDict(self):
+        content = self.header.content()
+        content['transactions'] = [transaction.toDict() for transaction in self.transactions]
+        return {'hash': self.header.hash, 'content': content}
+
+def blockHeader(block):
+    return {'hash': block['hash'], 'content': headerContent(block['content'])}
 
 def checkBlockHash(block, difficulty=2):
-    expectedHash = hashMessage(block['content'])
+    content = block['content']
+    if 'merkleRoot' in content:
+        # Hash the transaction dicts afresh rather than reusing a cached txid, so a transaction
+        # changed after it was first hashed is still caught
+        leaves = [hashMessage(transaction) for transaction in content['transactions']]
+        if merkleRootFromHashes(leaves) != content['merkleRoot']:
+            raise Exception(f"Block merkle root is invalid: block {content['index']}")
+    expectedHash = hashBlockContent(content)
     if expectedHash != block['hash']:
         raise Exception(f"Block hash is invalid: block {block['content']['index']}")
     if not block['hash'].startswith('0' * difficulty):
         raise Exception(f"Block hash does not meet difficulty at index {block['content']['index']}")
 
-def checkBlockValidity(block, parentBlock, state, difficulty=2):
-    checkBlockHash(block, difficulty)
+def checkBlockLinks(block, parentBlock):
     if block['content']['index'] != parentBlock['content']['index'] + 1:
         raise Exception(f"Block index is invalid: block {block['content']['index']}")
     if block['content']['parentHash'] != parentBlock['hash']:
         raise Exception(f"Block parent hash is invalid: block {block['content']['index']}")
+
+def applyBlockTransactions(block, state, signatures=None):
+    """Apply a block's transactions to state in place; signatures, if given, are precomputed verifySign results"""
+    overlay = StateOverlay(state)
     
-    temp_state = state.copy()
-    
-    for transaction in block['content']['transactions']:
+    for position, transaction in enumerate(block['content']['transactions']):
         if 'transaction' not in transaction:
             print("Malformed transaction:", transaction)
             raise Exception("Missing 'transaction' field")
 
-        if not isValid(temp_state, transaction):
+        if signatures is None:
+            valid = isValid(overlay, transaction)
+        else:
+            valid = isValid(overlay, transaction, checkSignature=False) and signatures[position]
+        if not valid:
             raise Exception(f"Block contains invalid transaction at index {block['content']['index']}")
-        temp_state = updateState(temp_state, transaction['transaction'])
+        overlay.apply(transaction['transaction'])
         
-    return temp_state
+    return overlay.commit()
+
+def checkBlockValidity(block, parentBlock, state, difficulty=2):
+    checkBlockHash(block, difficulty)
+    checkBlockLinks(block, parentBlock)
+    return applyBlockTransactions(block, state)
+
+def _initVerifier(keyIndex):
+    public_key_index.update(keyIndex)
+
+def _verifyBlock(args):
+    """Pool task: hash/proof-of-work error (or None) and signature results for one block"""
+    block, difficulty = args
+    try:
+        checkBlockHash(block, difficulty)
+        hashError = None
+    except Exception as e:
+        hashError = str(e)
+    signatures = [
+        'transaction' in transaction and verifySign(
+            canonicalJson(transaction['transaction']),
+            transaction.get('signature'),
+            transaction.get('publicKey')
+        )
+        for transaction in block['content']['transactions']
+    ]
+    return hashError, signatures
 
-def checkBlockChain(blockChain, difficulty=2):
-    import json
+def _verifyBlocks(pool, blocks, difficulty, chunksize, window):
+    """(block, verification) pairs in chain order, with at most two windows of blocks in flight"""
+    blocks = iter(blocks)
+    pending = None
+    while True:
+        batch = list(itertools.islice(blocks, window))
+        results = pool.imap(_verifyBlock, ((block, difficulty) for block in batch), chunksize) if batch else None
+        if pending:
+            yield from zip(*pending)
+        if not batch:
+            return
+        pending = (batch, results)
+
+def makeCheckpoint(block, state):
+    return {
+        'height': block['content']['index'],
+        'blockHash': block['hash'],
+        'state': dict(state),
+        'stateHash': hashMessage(state)
+    }
+
+def blockHashAt(blockChain, index):
+    if isinstance(blockChain, BlockStore):
+        return blockChain.blockHash(index)
+    return blockChain[index]['hash']
+
+def iterBlocks(blockChain, start=0):
+    if isinstance(blockChain, BlockStore):
+        return blockChain.iterBlocks(start)
+    return (blockChain[index] for index in range(start, len(blockChain)))
+
+def checkBlockChain(blockChain, difficulty=2, checkpoint=None, onCheckpoint=None, checkpointInterval=1000,
+                    workers=None):
     if not blockChain:
         raise Exception("Block chain is empty")
 
@@ -58,20 +237,54 @@ def checkBlockChain(blockChain, difficulty=2):
         except:
             raise Exception("Block chain is not a valid JSON object")
 
-    if not isinstance(blockChain, list):
+    if not isinstance(blockChain, Sequence):
         raise Exception("Block chain is not a list")
 
-    genesis_transaction = blockChain[0]['content']['transactions'][0]
-    state = genesis_transaction['transaction'].copy()
+    if checkpoint:
+        height = checkpoint['height']
+        if height >= len(blockChain) or blockHashAt(blockChain, height) != checkpoint['blockHash']:
+            raise Exception(f"Checkpoint at height {height} does not match the chain")
+        if hashMessage(checkpoint['state']) != checkpoint['stateHash']:
+            raise Exception(f"Checkpoint state at height {height} is corrupted")
+        state = dict(checkpoint['state'])
+    else:
+        height = 0
+        genesis_transaction = blockChain[0]['content']['transactions'][0]
+        state = genesis_transaction['transaction'].copy()
+        checkBlockHash(blockChain[0], difficulty)
 
-    checkBlockHash(blockChain[0], difficulty)
-    parent = blockChain[0]
+    parent = blockChain[height]
+    last = len(blockChain) - 1
+    indices = range(height + 1, len(blockChain))
 
-    for block in blockChain[1:]:
-        try:
-            state = checkBlockValidity(block, parent, state, difficulty)
-        except Exception as e:
-            raise Exception(f"Block {block['content']['index']} is invalid: {e}")
-        parent = block
+    # Hashes and signatures are independent per block, so check them in a process pool
+    # and keep only the state transitions sequential
+    pool = None
+    if workers and workers > 1 and len(indices) >= PARALLEL_MIN_BLOCKS:
+        pool = multiprocessing.Pool(workers, _initVerifier, (dict(public_key_index),))
+        chunksize = max(1, min(len(indices) // (workers * 4), VERIFY_CHUNK_BLOCKS))
+        blocks = _verifyBlocks(pool, iterBlocks(blockChain, height + 1), difficulty, chunksize, workers * chunksize)
+    else:
+        blocks = ((block, None) for block in iterBlocks(blockChain, height + 1))
+
+    try:
+        for index, (block, verified) in zip(indices, blocks):
+            try:
+                if verified is None:
+                    state = checkBlockValidity(block, parent, state, difficulty)
+                else:
+                    hashError, signatures = verified
+                    if hashError:
+                        raise Exception(hashError)
+                    checkBlockLinks(block, parent)
+                    state = applyBlockTransactions(block, state, signatures)
+            except Exception as e:
+                raise Exception(f"Block {block['content']['index']} is invalid: {e}")
+            parent = block
+            if onCheckpoint and (index % checkpointInterval == 0 or index == last):
+                onCheckpoint(makeCheckpoint(block, state))
+    finally:
+        if pool is not None:
+            pool.terminate()
 
     return state
@@ -0,0 +1,98 @@
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
+
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+# A parsed block (dicts, strings, ints) takes about this many bytes of memory per byte of its
+# log line; measured with tracemalloc at 2.9 for 1000-transaction blocks, 3.9 for one-transaction blocks
+PARSED_BYTES_PER_LOG_BYTE = 3
+
+class BlockStore(Sequence):
+    """List-like view of the chain backed by the block log.
+
+    Offsets and hashes for every block stay in compact arrays in memory; block bodies are
+    read from disk on access and recently used ones are kept in an LRU cache. The cache
+    budget is in bytes of memory; each cached block is charged an estimate of its parsed
+    size, its log line length times PARSED_BYTES_PER_LOG_BYTE.
+    """
+    def __init__(self, storage, cacheBytes=DEFAULT_CACHE_BYTES):
+        self.storage = storage
+        self.cacheBytes = cacheBytes
+        self.cache = OrderedDict()
+        self.cachedBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.storage.block_offsets)
+
+    def _index(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("block index out of range")
+        return index
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        index = self._index(index)
+        with self.lock:
+            if index in self.cache:
+                self.cache.move_to_end(index)
+                self.hits += 1
+                return self.cache[index][0]
+            self.misses += 1
+        block = self.storage.read_block(index)
+        self._remember(index, block)
+        return block
+
+    def _remember(self, index, block):
+        size = self.storage.block_size(index) * PARSED_BYTES_PER_LOG_BYTE
+        if size > self.cacheBytes:
+            return
+        with self.lock:
+            if index in self.cache:
+                return
+            self.cache[index] = (block, size)
+            self.cachedBytes += size
+            while self.cachedBytes > self.cacheBytes:
+                _, (_, evictedSize) = self.cache.popitem(last=False)
+                self.cachedBytes -= evictedSize
+                self.evictions += 1
+
+    def __iter__(self):
+        return self.storage.iter_blocks()
+
+    def iterBlocks(self, start=0):
+        """Sequential read from start, cheaper than indexing block by block; bypasses the cache"""
+        return self.storage.iter_blocks(start)
+
+    def blockHash(self, index):
+        """Hash of a block from the in-memory index, without reading its body"""
+        return self.storage.block_hash(self._index(index))
+
+    def append(self, block):
+        if not self.storage.append_block(block):
+            raise Exception(f"Failed to append block {block['content']['index']}")
+        self._remember(len(self) - 1, block)
+
+    def clearCache(self):
+        with self.lock:
+            self.cache.clear()
+            self.cachedBytes = 0
+
+    def cacheStats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'cached_blocks': len(self.cache),
+                'cached_bytes': self.cachedBytes,
+                'budget_bytes': self.cacheBytes
+            }
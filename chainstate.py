@@ -0,0 +1,34 @@
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+from blockchain import blockHashAt
+
+# What readers see: chain length and tip, balances, and username -> public key
+ChainView = namedtuple('ChainView', ['length', 'tipHash', 'state', 'users'])
+
+class ChainStateManager:
+    """Single writer for the chain state, with immutable views published for lock-free readers.
+
+    Writers (transaction admission, block commits, user creation) hold lock while they change
+    the block store, the state dict, the mempool or the users, and call publish() before
+    releasing it. Readers take view, a single attribute read, and never lock: a view is never
+    modified once published, so a request sees one consistent height, state and user set.
+    """
+    def __init__(self, blockChain, state, users):
+        self.blockChain = blockChain
+        self.state = state
+        self.users = users
+        self.lock = threading.RLock()
+        self.view = ChainView(0, None, MappingProxyType({}), MappingProxyType({}))
+
+    def publish(self, stateChanged=True, usersChanged=True):
+        """Publish the current chain state; caller holds lock. Unchanged parts are shared with the previous view"""
+        previous = self.view
+        state = MappingProxyType(dict(self.state)) if stateChanged else previous.state
+        if usersChanged:
+            users = MappingProxyType({username: info['public_key'] for username, info in self.users.items()})
+        else:
+            users = previous.users
+        length = len(self.blockChain)
+        self.view = ChainView(length, blockHashAt(self.blockChain, -1) if length else None, state, users)
+        return self.view
@@ -30,7 +30,7 @@ curl -s $BASE_URL/pending | python -m json.tool
 echo
 
 echo "6. Mine a block:"
-curl -s -X POST $BASE_URL/mine | python -m json.tool
+curl -s -X POST "$BASE_URL/mine?wait=1" | python -m json.tool
 echo
 
 echo "7. Get blockchain stats:"
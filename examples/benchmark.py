@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the blockchain core
+
+Usage: python examples/benchmark.py <name>
+"""
+
+import sys
+import os
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+def bench_state():
+    """Apply a 1,000-transaction block over growing account counts"""
+    from state import updateState, StateOverlay
+
+    txCount = 1000
+    print(f"{'accounts':>10} {'copy us/tx':>12} {'overlay us/tx':>14}")
+    for accounts in (1000, 10000, 100000):
+        state = {f"user{i}": 100 for i in range(accounts)}
+        transactions = [{f"user{i}": -1, f"user{i + 1}": 1} for i in range(txCount)]
+
+        def copying():
+            current = state
+            for transaction in transactions:
+                current = updateState(current, transaction)
+
+        base = dict(state)
+
+        def journaled():
+            overlay = StateOverlay(base)
+            for transaction in transactions:
+                overlay.apply(transaction)
+            overlay.commit()
+
+        copyTime = timed(copying) / txCount * 1e6
+        overlayTime = timed(journaled) / txCount * 1e6
+        print(f"{accounts:>10} {copyTime:>12.2f} {overlayTime:>14.2f}")
+
+def bench_sqlite():
+    """Concurrent readers and a writer against per-call connections vs the WAL pool"""
+    import sqlite3
+    import tempfile
+    import threading
+    from contextlib import contextmanager
+    from storage import BlockchainStorage
+
+    class PerCallStorage(BlockchainStorage):
+        @contextmanager
+        def get_db_connection(self):
+            conn = sqlite3.connect(self.pool.database_file, timeout=30)
+            conn.row_factory = sqlite3.Row
+            try:
+                yield conn
+            finally:
+                conn.close()
+
+    def makeBlock(index):
+        transactions = [{'transaction': {'alice': -1, f"user{i}": 1}} for i in range(50)]
+        return {'hash': f"{index:064x}", 'content': {
+            'index': index, 'parentHash': None, 'transactionCount': len(transactions),
+            'transactions': transactions, 'nonce': 0, 'timestamp': '2024-01-01T00:00:00'
+        }}
+
+    def run(storageClass, readers=4, duration=2.0):
+        with tempfile.TemporaryDirectory() as directory:
+            storage = storageClass(os.path.join(directory, 'bench.db'))
+            for index in range(200):
+                storage.save_block_metadata(makeBlock(index), 2)
+            counts = {'reads': 0, 'writes': 0}
+            stop = threading.Event()
+
+            def reader():
+                while not stop.is_set():
+                    storage.get_transaction_history(username='alice', limit=20)
+                    storage.get_blockchain_stats()
+                    counts['reads'] += 1
+
+            def writer():
+                index = 200
+                while not stop.is_set():
+                    storage.save_block_metadata(makeBlock(index), 2)
+                    index += 1
+                    counts['writes'] += 1
+
+            threads = [threading.Thread(target=reader) for _ in range(readers)]
+            threads.append(threading.Thread(target=writer))
+            for thread in threads:
+                thread.start()
+            time.sleep(duration)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            return counts['reads'] / duration, counts['writes'] / duration
+
+    print(f"{'mode':>10} {'reads/s':>10} {'writes/s':>10}")
+    for name, storageClass in (('per-call', PerCallStorage), ('pooled', BlockchainStorage)):
+        reads, writes = run(storageClass)
+        print(f"{name:>10} {reads:>10.0f} {writes:>10.0f}")
+
+def bench_validate():
+    """Validate a 2,000-block chain serially and with the parallel pipeline"""
+    from blockchain import makeGenesisBlock, makeBlock, checkBlockChain
+    from transaction import makeTransaction
+    from user import generateKeys
+
+    users = [f"user{i}" for i in range(20)]
+    for name in users:
+        generateKeys(name)
+    genesis = {'transaction': {name: 1000 for name in users}, 'publicKey': None, 'signature': None}
+    chain = [makeGenesisBlock([genesis], difficulty=1)]
+    for index in range(2000):
+        transactions = [makeTransaction(users[i], users[(i + 1) % len(users)], 1) for i in range(len(users))]
+        chain.append(makeBlock(chain, transactions, difficulty=1))
+
+    serial = timed(checkBlockChain, chain, 1)
+    print(f"{'serial':>12} {serial:.2f}s")
+    for workers in sorted({2, 4, os.cpu_count() or 1} - {1}):
+        parallel = timed(lambda: checkBlockChain(chain, 1, workers=workers))
+        print(f"{workers:>4} workers {parallel:.2f}s")
+
+def bench_mempool():
+    """Mine 1,000 transactions out of 100,000 pending: list scan vs indexed mempool"""
+    from mempool import Mempool
+
+    pendingCount, minedCount = 100000, 1000
+    pending = [{'transaction': {f"user{i % 5000}": -1, f"user{(i + 1) % 5000}": 1},
+                'publicKey': None, 'signature': None, 'timestamp': str(i)} for i in range(pendingCount)]
+    state = {f"user{i}": 1000 for i in range(5000)}
+
+    pool = list(pending)
+    mined = pending[-minedCount:]
+
+    def listRemove():
+        for transaction in mined:
+            if transaction in pool:
+                pool.remove(transaction)
+
+    mempool = Mempool()
+    add = timed(lambda: [mempool.add(transaction) for transaction in pending])
+    minedIds = list(mempool.transactions)[-minedCount:]
+
+    def indexedRemove():
+        for txid in minedIds:
+            mempool.remove(txid)
+
+    afford = timed(lambda: [mempool.canAfford(state, transaction['transaction']) for transaction in pending])
+    print(f"mempool add {pendingCount}: {add:.2f}s, canAfford x{pendingCount}: {afford:.3f}s")
+    print(f"remove {minedCount} mined: list {timed(listRemove):.2f}s, mempool {timed(indexedRemove) * 1000:.2f}ms")
+
+def bench_canonical():
+    """Admit, journal, mine and persist 20,000 transactions, encoding at every step vs once per Transaction"""
+    from hash_utils import canonicalJson, hashMessage
+    from keys import signMessage
+    from user import public_key_index
+    from state import isValid
+    from transaction import Transaction
+    from merkle import merkleRoot, merkleRootFromHashes
+    from storage import transaction_rows, pending_record_json
+
+    txCount = 20000
+    state = {f"user{i}": 1000 for i in range(1000)}
+    public_key_index['bench'] = 'key'
+    signed = []
+    for i in range(txCount):
+        transaction = {f"user{i % 1000}": -1, f"user{(i + 1) % 1000}": 1}
+        signed.append({'transaction': transaction, 'publicKey': 'bench', 'timestamp': str(i),
+                       'signature': signMessage(canonicalJson(transaction), 'key')})
+
+    def eachStep():
+        for transaction in signed:
+            isValid(state, transaction)
+            txid = hashMessage(transaction)
+            len(canonicalJson(transaction))
+            pending_record_json({'op': 'add', 'id': txid, 'tx': transaction})
+        merkleRoot(signed)
+        list(transaction_rows(signed))
+
+    def once():
+        pending = []
+        for transaction in signed:
+            transaction = Transaction.fromDict(transaction)
+            isValid(state, transaction)
+            txid = transaction.txid()
+            len(transaction.json())
+            pending_record_json({'op': 'add', 'id': txid, 'tx': transaction})
+            pending.append(transaction)
+        merkleRootFromHashes([transaction.txid() for transaction in pending])
+        list(transaction_rows(pending))
+
+    print(f"{'':>10} {'total s':>8} {'us/tx':>8}")
+    for name, pipeline in (('each step', eachStep), ('once', once)):
+        elapsed = timed(pipeline)
+        print(f"{name:>10} {elapsed:>8.2f} {elapsed / txCount * 1e6:>8.1f}")
+
+def bench_memory():
+    """Resident size of a 1M-transaction chain: nested dicts vs slotted Block/Transaction objects"""
+    import gc
+    import tracemalloc
+    from blockchain import Block
+
+    blockCount, perBlock = 1000, 1000
+    publicKeys = [f"{i:064x}" for i in range(1000)]
+
+    def makeBlockDict(index):
+        transactions = [{
+            'transaction': {f"user{i % 1000}": -1, f"user{(i + 1) % 1000}": 1},
+            'publicKey': publicKeys[i % 1000],
+            'signature': f"{index * perBlock + i:064x}",
+            'timestamp': f"2024-01-01T00:00:{i % 60:02d}.{index:06d}"
+        } for i in range(perBlock)]
+        return {'hash': f"{index:064x}", 'content': {
+            'index': index, 'parentHash': f"{index - 1:064x}", 'transactionCount': perBlock,
+            'merkleRoot': f"{index:064x}", 'transactions': transactions, 'nonce': index,
+            'timestamp': '2024-01-01T00:00:00'
+        }}
+
+    def measure(build):
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        chain = [build(index) for index in range(blockCount)]
+        elapsed = time.perf_counter() - start
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del chain
+        return size, elapsed
+
+    print(f"{'':>8} {'MB':>8} {'bytes/tx':>9} {'build s':>8}")
+    for name, build in (('dicts', makeBlockDict), ('slotted', lambda index: Block.fromDict(makeBlockDict(index)))):
+        size, elapsed = measure(build)
+        print(f"{name:>8} {size / 1e6:>8.0f} {size / (blockCount * perBlock):>9.0f} {elapsed:>8.1f}")
+
+BENCHMARKS = {
+    'state': bench_state,
+    'sqlite': bench_sqlite,
+    'validate': bench_validate,
+    'mempool': bench_mempool,
+    'canonical': bench_canonical,
+    'memory': bench_memory,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"== {name}: {BENCHMARKS[name].__doc__}")
+        BENCHMARKS[name]()
@@ -12,6 +12,57 @@ from transaction import makeTransaction
 from user import generateKeys
 from hash_utils import hashMessage
 import json
+import tempfile
+from contextlib import contextmanager
+
+@contextmanager
+def in_temporary_directory():
+    """Run with a fresh working directory, where storage keeps its data files"""
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            yield directory
+        finally:
+            os.chdir(previous)
+
+def make_signed_chain(length, difficulty=1):
+    """Genesis plus length - 1 blocks of one alice -> bob transfer each"""
+    from blockchain import makeGenesisBlock
+
+    generateKeys('alice')
+    generateKeys('bob')
+    genesis_tx = {'transaction': {'alice': 50, 'bob': 50}, 'publicKey': None, 'signature': None}
+    blockchain = [makeGenesisBlock([genesis_tx], difficulty=difficulty, timestamp='2024-01-01T00:00:00')]
+    for i in range(1, length):
+        blockchain.append(makeBlock(blockchain, [makeTransaction('alice', 'bob', 1)], difficulty=difficulty,
+                                    timestamp=f'2024-01-01T00:00:{i:02d}'))
+    return blockchain
+
+@contextmanager
+def started_server():
+    """A freshly imported main module at difficulty 1, started on the data files in the working directory"""
+    import atexit
+    import importlib
+    import pytest
+    pytest.importorskip('flask')
+
+    sys.modules.pop('main', None)
+    main = importlib.import_module('main')
+    atexit.unregister(main.save_all_data)
+    main.difficulty = 1
+    try:
+        main.initialize_blockchain()
+        yield main
+    finally:
+        main.storage.pool.close_all()
+        sys.modules.pop('main', None)
+
+@contextmanager
+def api_client():
+    """started_server() in a temporary directory, with its Flask test client"""
+    with in_temporary_directory(), started_server() as main:
+        yield main, main.app.test_client()
 
 def test_basic_functionality():
     print("Testing basic blockchain functionality...")
@@ -67,5 +118,601 @@ def test_basic_functionality():
     
     print("All tests passed!")
 
+def test_parallel_miner():
+    from blockchain import makeGenesisBlock, checkBlockHash
+    from miner import ParallelMiner
+
+    genesis_tx = {
+        'transaction': {'alice': 50, 'bob': 50},
+        'publicKey': None,
+        'signature': None
+    }
+    block = makeGenesisBlock([genesis_tx], difficulty=3, miner=ParallelMiner(workers=2, chunkSize=500))
+    checkBlockHash(block, difficulty=3)
+
+def test_miner_cancel():
+    import threading
+    from miner import ParallelMiner, MiningCancelled
+
+    content = {'index': 0, 'transactions': [], 'nonce': 0}
+    for workers in (1, 2):
+        miner = ParallelMiner(workers=workers, chunkSize=500)
+        timer = threading.Timer(0.2, miner.cancel)
+        timer.start()
+        try:
+            miner.mine(dict(content), difficulty=64)
+            assert False, "mining should have been cancelled"
+        except MiningCancelled:
+            pass
+        timer.join()
+
+        # A cancel sent before the search starts still stops it, and is used up by that job
+        miner.cancel()
+        try:
+            miner.mine(dict(content), difficulty=64)
+            assert False, "mining should have been cancelled"
+        except MiningCancelled:
+            pass
+        assert miner.mine(dict(content), difficulty=1).startswith('0')
+
+def test_nonce_hasher_matches_hash_message():
+    from miner import nonceHasher
+
+    content = {
+        'index': 1,
+        'parentHash': 'ab' * 32,
+        'transactionCount': 1,
+        'transactions': [{'transaction': {'alice': -1, 'bob': 1}, 'publicKey': None, 'signature': None}],
+        'nonce': 0,
+        'timestamp': '2024-01-01T00:00:00'
+    }
+    hashNonce = nonceHasher(content)
+    for nonce in (0, 7, 123456):
+        content['nonce'] = nonce
+        assert hashNonce(nonce) == hashMessage(content)
+
+def test_state_overlay_rollback():
+    from state import StateOverlay
+
+    base = {'alice': 10, 'bob': 5}
+    overlay = StateOverlay(base)
+    overlay.apply({'alice': -3, 'bob': 3})
+    checkpoint = overlay.checkpoint()
+    overlay.apply({'bob': -8, 'carol': 8})
+    overlay.rollback(checkpoint)
+    assert overlay.get('bob') == 8 and overlay.get('carol', 0) == 0
+    assert base == {'alice': 10, 'bob': 5}
+    assert overlay.commit() == {'alice': 7, 'bob': 8}
+
+def test_incremental_validation_from_checkpoint():
+    from blockchain import makeGenesisBlock
+
+    generateKeys('alice')
+    generateKeys('bob')
+    genesis_tx = {
+        'transaction': {'alice': 50, 'bob': 50},
+        'publicKey': None,
+        'signature': None
+    }
+    blockchain = [makeGenesisBlock([genesis_tx], difficulty=1)]
+    for i in range(4):
+        blockchain.append(makeBlock(blockchain, [makeTransaction('alice', 'bob', 1)], difficulty=1))
+
+    checkpoints = []
+    full_state = checkBlockChain(blockchain, 1, onCheckpoint=checkpoints.append, checkpointInterval=2)
+    assert [c['height'] for c in checkpoints] == [2, 4]
+
+    blockchain.append(makeBlock(blockchain, [makeTransaction('bob', 'alice', 1)], difficulty=1))
+    incremental_state = checkBlockChain(blockchain, 1, checkpoint=checkpoints[0])
+    assert incremental_state == checkBlockChain(blockchain, 1)
+    assert sum(incremental_state.values()) == sum(full_state.values())
+
+    tampered = dict(checkpoints[0], blockHash='0' * 64)
+    try:
+        checkBlockChain(blockchain, 1, checkpoint=tampered)
+    except Exception as e:
+        assert 'does not match' in str(e)
+    else:
+        raise AssertionError("tampered checkpoint accepted")
+
+def test_parallel_validation_reports_same_block():
+    import blockchain as chain_module
+    from blockchain import makeGenesisBlock
+
+    generateKeys('alice')
+    generateKeys('bob')
+    genesis_tx = {
+        'transaction': {'alice': 50, 'bob': 50},
+        'publicKey': None,
+        'signature': None
+    }
+    blockchain = [makeGenesisBlock([genesis_tx], difficulty=1)]
+    for i in range(6):
+        blockchain.append(makeBlock(blockchain, [makeTransaction('alice', 'bob', 1)], difficulty=1))
+    blockchain[4]['content']['transactions'][0]['signature'] = '0' * 64
+    blockchain[4] = makeBlock(blockchain[:4], blockchain[4]['content']['transactions'], difficulty=1)
+    blockchain[5]['hash'] = '0' * 64
+
+    errors = []
+    original_min_blocks = chain_module.PARALLEL_MIN_BLOCKS
+    chain_module.PARALLEL_MIN_BLOCKS = 1
+    try:
+        for workers in (None, 2):
+            try:
+                checkBlockChain(blockchain, 1, workers=workers)
+            except Exception as e:
+                errors.append(str(e))
+    finally:
+        chain_module.PARALLEL_MIN_BLOCKS = original_min_blocks
+    assert len(errors) == 2 and errors[0] == errors[1]
+    assert errors[0].startswith('Block 4 is invalid')
+
+def test_transaction_changed_after_signing_is_rejected():
+    from blockchain import makeGenesisBlock
+
+    generateKeys('alice')
+    generateKeys('bob')
+    genesis_tx = {'transaction': {'alice': 50, 'bob': 50}, 'publicKey': None, 'signature': None}
+    blockchain = [makeGenesisBlock([genesis_tx], difficulty=1)]
+    forged = makeTransaction('alice', 'bob', 1)
+    forged['transaction'].update({'alice': -40, 'bob': 40})
+    blockchain.append(makeBlock(blockchain, [forged], difficulty=1))
+
+    errors = []
+    for workers in (None, 2):
+        try:
+            checkBlockChain(blockchain, 1, workers=workers)
+        except Exception as e:
+            errors.append(str(e))
+    assert len(errors) == 2 and errors[0] == errors[1]
+    assert errors[0].startswith('Block 1 is invalid')
+
+def test_mempool_tracks_sender_spend():
+    from mempool import Mempool
+
+    mempool = Mempool()
+    first = mempool.add({'transaction': {'alice': -30, 'bob': 30}, 'publicKey': None, 'signature': None})
+    mempool.add({'transaction': {'alice': -50, 'carol': 50}, 'publicKey': None, 'signature': None})
+    state = {'alice': 100}
+    assert mempool.pendingSpend('alice') == 80
+    assert mempool.canAfford(state, {'alice': -20, 'bob': 20})
+    assert not mempool.canAfford(state, {'alice': -21, 'bob': 21})
+
+    mempool.remove(first)
+    assert len(mempool) == 1 and first not in mempool
+    assert mempool.pendingSpend('alice') == 50
+    assert [tx.transaction for tx in mempool.senderQueue('alice')] == [{'alice': -50, 'carol': 50}]
+
+def test_block_template_compacts_and_unparks():
+    from mempool import Mempool
+    from template import BlockTemplate, HEAP_SLACK
+
+    mempool = Mempool()
+    template = BlockTemplate(mempool, maxTransactions=10)
+    for i in range(1000):
+        txid = mempool.add({'transaction': {'alice': -1, 'bob': 1}, 'publicKey': None, 'signature': None,
+                            'timestamp': str(i)})
+        template.add(txid, mempool.get(txid))
+    while mempool:
+        for txid, _ in template.transactions():
+            mempool.remove(txid)
+            template.discard(txid)
+        template.fill()
+    assert len(template.worst) <= HEAP_SLACK and len(template.backlog) <= HEAP_SLACK
+
+    ids = [mempool.add({'transaction': {'alice': -i, 'bob': i}, 'publicKey': None, 'signature': None})
+           for i in range(1, 4)]
+    for txid in ids:
+        template.add(txid, mempool.get(txid))
+    template.park(ids[0])
+    assert [txid for txid, _ in template.transactions()] == ids[1:]
+    template.unpark([ids[0]])
+    assert [txid for txid, _ in template.transactions()] == ids and not template.parked
+
+def test_merkle_proofs_and_header_hash():
+    from merkle import transactionHashes, merkleProof, merkleRoot, verifyMerkleProof
+    from blockchain import makeGenesisBlock, checkBlockHash
+
+    transactions = [{'transaction': {'alice': -i, 'bob': i}, 'publicKey': None, 'signature': None}
+                    for i in range(1, 8)]
+    leaves = transactionHashes(transactions)
+    root = merkleRoot(transactions)
+    for position, leaf in enumerate(leaves):
+        assert verifyMerkleProof(leaf, merkleProof(leaves, position), root)
+    assert not verifyMerkleProof(leaves[0], merkleProof(leaves, 1), root)
+
+    block = makeGenesisBlock(transactions, difficulty=1)
+    checkBlockHash(block, difficulty=1)
+    block['content']['transactions'] = transactions[:-1]
+    try:
+        checkBlockHash(block, difficulty=1)
+        assert False, "tampered transactions should be rejected"
+    except Exception as e:
+        assert 'merkle root' in str(e)
+
+def test_block_log_migration_append_and_torn_tail():
+    from storage import BlockchainStorage, BLOCKCHAIN_FILE, BLOCK_LOG_FILE
+
+    blockchain = make_signed_chain(4)
+    with in_temporary_directory():
+        with open(BLOCKCHAIN_FILE, 'w') as f:
+            json.dump(blockchain[:2], f)
+        storage = BlockchainStorage()
+        assert storage.scan_block_log() == 2
+        assert not os.path.exists(BLOCKCHAIN_FILE) and os.path.exists(BLOCKCHAIN_FILE + '.migrated')
+        assert [storage.read_block(i) for i in range(2)] == blockchain[:2]
+
+        assert storage.save_blockchain(blockchain)
+        assert list(storage.iter_blocks(1)) == blockchain[1:]
+        assert [storage.block_hash(i) for i in range(4)] == [block['hash'] for block in blockchain]
+
+        # A crash part-way through an append leaves a line without its newline
+        size = os.path.getsize(BLOCK_LOG_FILE)
+        with open(BLOCK_LOG_FILE, 'ab') as f:
+            f.write(json.dumps(blockchain[3]).encode('utf-8')[:40])
+        reopened = BlockchainStorage()
+        assert reopened.scan_block_log() == 4
+        assert os.path.getsize(BLOCK_LOG_FILE) == size
+        assert reopened.read_block(3) == blockchain[3]
+
+def test_block_log_truncates_corrupt_tail():
+    from storage import BlockchainStorage, BLOCK_LOG_FILE
+
+    blockchain = make_signed_chain(3)
+    with in_temporary_directory():
+        storage = BlockchainStorage()
+        storage.save_blockchain(blockchain)
+        last_offset = storage.block_offsets[-1]
+        with open(BLOCK_LOG_FILE, 'rb') as f:
+            data = f.read()
+        # A crash can leave the final line newline-terminated but with a zero-filled end
+        tail = data[last_offset:-1]
+        with open(BLOCK_LOG_FILE, 'wb') as f:
+            f.write(data[:last_offset] + tail[:len(tail) // 2] + b'\0' * (len(tail) - len(tail) // 2) + b'\n')
+
+        reopened = BlockchainStorage()
+        assert reopened.scan_block_log() == 2
+        assert os.path.getsize(BLOCK_LOG_FILE) == last_offset
+        assert [reopened.block_hash(i) for i in range(2)] == [block['hash'] for block in blockchain[:2]]
+        assert reopened.read_block(1) == blockchain[1]
+
+def test_pending_journal_replay_and_compaction():
+    import storage as storage_module
+    from storage import BlockchainStorage, PENDING_LOG_FILE
+    from transaction import Transaction
+
+    transactions = [Transaction.fromDict({'transaction': {'alice': -i, 'bob': i}, 'publicKey': None,
+                                          'signature': None}) for i in range(1, 7)]
+    with in_temporary_directory():
+        storage = BlockchainStorage()
+        storage.append_pending_batch([(tx.txid(), tx) for tx in transactions[:4]])
+        storage.remove_pending([transactions[0].txid(), transactions[2].txid()])
+
+        reopened = BlockchainStorage()
+        assert reopened.load_pending_transactions() == [tx.toDict() for tx in (transactions[1], transactions[3])]
+        assert reopened.pending_tombstones == 2
+
+        # A transaction journaled while the compacted copy is being written must survive the swap
+        encode = storage_module.pending_record_json
+        appended = []
+        def encode_and_append(record):
+            if reopened.pending_written is not None and not appended:
+                appended.append(record)
+                reopened.append_pending(transactions[4], transactions[4].txid())
+                reopened.remove_pending([transactions[1].txid()])
+            return encode(record)
+        storage_module.pending_record_json = encode_and_append
+        try:
+            assert reopened.compact_pending()
+        finally:
+            storage_module.pending_record_json = encode
+
+        with open(PENDING_LOG_FILE) as f:
+            ops = [json.loads(line)['op'] for line in f]
+        assert ops == ['add', 'add', 'add', 'del']
+        assert reopened.pending_tombstones == 1
+        assert BlockchainStorage().load_pending_transactions() == [tx.toDict() for tx in (transactions[3], transactions[4])]
+
+def test_reindex_resumes_and_fills_difficulty():
+    from storage import BlockchainStorage
+
+    blockchain = make_signed_chain(5)
+    with in_temporary_directory():
+        # Only the block log survives; the database is rebuilt from it
+        storage = BlockchainStorage()
+        storage.save_blockchain(blockchain)
+
+        def interrupt(blocks, rows, elapsed):
+            raise KeyboardInterrupt
+        try:
+            storage.reindex(workers=1, batch_size=2, report=interrupt, default_difficulty=3)
+            assert False, "reindex should have been interrupted"
+        except KeyboardInterrupt:
+            pass
+        with storage.get_db_connection() as conn:
+            assert conn.execute('SELECT next_block FROM reindex_progress').fetchone()[0] == 2
+
+        assert storage.reindex(workers=1, batch_size=2, default_difficulty=3)[0] == 5
+        with storage.get_db_connection() as conn:
+            rows = conn.execute('SELECT block_index, timestamp, difficulty FROM blocks ORDER BY block_index')
+            assert [tuple(row) for row in rows] == [
+                (i, block['content']['timestamp'], 3) for i, block in enumerate(blockchain)
+            ]
+            assert conn.execute('SELECT COUNT(*) FROM reindex_progress').fetchone()[0] == 0
+        stats = storage.get_blockchain_stats()
+        assert stats['block_count'] == 5 and stats['transaction_count'] == 5
+        assert stats['transactions_per_second'] is not None
+        assert storage.get_balance_at('alice', 4) + storage.get_balance_at('bob', 4) == 100
+
+def test_balance_at_each_height():
+    from storage import BlockchainStorage
+
+    blockchain = make_signed_chain(4)
+    blockchain.append(makeBlock(blockchain, [makeTransaction('bob', 'carol', 5), makeTransaction('alice', 'bob', 2)],
+                                difficulty=1, timestamp='2024-01-01T00:00:04'))
+    blockchain.append(makeBlock(blockchain, [makeTransaction('bob', 'alice', 3)], difficulty=1,
+                                timestamp='2024-01-01T00:00:05'))
+
+    # Running balances after each block, as get_balance_at should report them
+    expected = []
+    state = {}
+    for block in blockchain:
+        for transaction in block['content']['transactions']:
+            for username, delta in transaction['transaction'].items():
+                state[username] = state.get(username, 0) + delta
+        expected.append(dict(state))
+
+    with in_temporary_directory():
+        # Blocks saved as they are mined, then the rest backfilled as on startup
+        storage = BlockchainStorage()
+        for block in blockchain[:3]:
+            storage.save_block_metadata(block, 1)
+        assert storage.balances_height() == 2
+        storage.save_block_balances(blockchain[3:])
+        assert storage.balances_height() == 5
+
+        for height, balances in enumerate(expected):
+            for username in ('alice', 'bob', 'carol'):
+                assert storage.get_balance_at(username, height) == balances.get(username, 0)
+            assert storage.get_balances_at(None, height) == balances
+        assert storage.get_balance_at('carol', 3) == 0 and storage.get_balance_at('carol', 99) == expected[-1]['carol'] > 0
+        assert storage.get_balances_at(['alice', 'dave'], -1) == {'alice': 0, 'dave': 0}
+
+def test_history_stream_matches_pages():
+    from storage import BlockchainStorage
+
+    with in_temporary_directory():
+        storage = BlockchainStorage()
+        with storage.get_db_connection() as conn:
+            pairs = [('alice', 'bob'), ('bob', 'alice'), ('alice', 'alice'), ('bob', 'carol')] * 25
+            conn.executemany(
+                "INSERT INTO transactions (block_index, sender, receiver, amount, transaction_hash, timestamp) "
+                "VALUES (?, ?, ?, 1, '{}', '2024-01-01T00:00:00')",
+                [(i // 10, sender, receiver) for i, (sender, receiver) in enumerate(pairs)]
+            )
+            conn.commit()
+        for filters in ({}, {'after_id': 20}, {'before_id': 80, 'from_block': 2}):
+            page = [row['id'] for row in storage.get_transaction_history('alice', limit=None, **filters)]
+            streamed = [row['id'] for row in storage.iter_transaction_history('alice', **filters)]
+            assert streamed == page and len(set(streamed)) == len(streamed)
+            assert [row['id'] for row in storage.iter_transaction_history('alice', limit=5, **filters)] == page[:5]
+
+def test_snapshot_load_replays_later_blocks():
+    from storage import STATE_FILE
+
+    with in_temporary_directory():
+        with started_server() as main:
+            client = main.app.test_client()
+            client.post('/transaction', json={'sender': 'alice', 'receiver': 'bob', 'amount': 10})
+            main.mine_pending_block()
+            main.save_snapshot()
+            for amount in (20, 5):
+                client.post('/transaction', json={'sender': 'bob', 'receiver': 'alice', 'amount': amount})
+                main.mine_pending_block()
+            expected_state = dict(main.current_state)
+            expected_tip = main.blockChain.blockHash(-1)
+        assert expected_state['alice'] == 115 and expected_state['bob'] == 85
+
+        # Without the state file, the balances can only come from the snapshot plus the replayed blocks
+        os.remove(STATE_FILE)
+        with started_server() as main:
+            assert main.storage.load_snapshot()['height'] == 1
+            assert len(main.blockChain) == 4 and main.blockChain.blockHash(-1) == expected_tip
+            assert main.current_state == expected_state
+            assert main.current_state == checkBlockChain(main.blockChain, 1)
+
+def test_blocks_api_ranges_and_headers():
+    with api_client() as (main, client):
+        for amount in (1, 2, 3):
+            client.post('/transaction', json={'sender': 'alice', 'receiver': 'bob', 'amount': amount})
+            main.mine_pending_block()
+
+        body = client.get('/blocks?from=1&to=2').get_json()
+        assert (body['from'], body['to'], body['length']) == (1, 2, 4)
+        assert [block['content']['index'] for block in body['blocks']] == [1, 2]
+        assert body['blocks'] == [main.blockChain[1], main.blockChain[2]]
+
+        headers = client.get('/blocks?from=2&headers=1').get_json()
+        assert [block['hash'] for block in headers['blocks']] == [main.blockChain.blockHash(i) for i in (2, 3)]
+        assert all('transactions' not in block['content'] and block['content']['merkleRoot']
+                   for block in headers['blocks'])
+
+        assert client.get('/blocks?from=10').get_json()['blocks'] == []
+        assert client.get('/blocks?from=3&to=1').status_code == 400
+        assert len(client.get('/blockchain').get_json()['blockchain']) == 4
+
+def test_transaction_batch_api():
+    from storage import PENDING_LOG_FILE
+
+    with api_client() as (main, client):
+        writes = []
+        write_pending_records = main.storage._write_pending_records
+        def counting_write(records, mode='ab'):
+            writes.append(len(records))
+            return write_pending_records(records, mode)
+        main.storage._write_pending_records = counting_write
+
+        response = client.post('/transactions/batch', json={'transactions': [
+            {'sender': 'alice', 'receiver': 'bob', 'amount': 60},
+            {'sender': 'alice', 'receiver': 'bob', 'amount': 60},
+            {'sender': 'carol', 'receiver': 'bob', 'amount': 1},
+            {'sender': 'bob', 'receiver': 'alice', 'amount': -1},
+            {'sender': 'bob', 'receiver': 'alice', 'amount': 5, 'fee': 1}
+        ]})
+        body = response.get_json()
+        assert (body['accepted'], body['rejected']) == (2, 3)
+        assert [result['status'] for result in body['results']] == \
+            ['accepted', 'rejected', 'rejected', 'rejected', 'accepted']
+        assert body['results'][1]['error'] == "Insufficient balance"
+        assert body['results'][2]['error'] == "Sender carol does not exist"
+        assert body['results'][3]['error'] == "Amount must be positive"
+
+        # The accepted transactions are journaled together, in order
+        assert writes == [2]
+        with open(PENDING_LOG_FILE) as f:
+            journaled = [json.loads(line)['tx'] for line in f]
+        accepted = [result['transaction'] for result in body['results'] if result['status'] == 'accepted']
+        assert journaled == accepted and main.mempool.toDicts() == accepted
+
+        assert client.post('/transactions/batch', json=[]).status_code == 400
+        too_many = [{'sender': 'alice', 'receiver': 'bob', 'amount': 1}] * (main.MAX_BATCH_TRANSACTIONS + 1)
+        assert client.post('/transactions/batch', json=too_many).status_code == 400
+        assert writes == [2]
+
+def test_mining_scheduler_jobs():
+    import threading
+    from miner import MiningCancelled
+    from scheduler import MiningScheduler
+
+    class GatedMiner:
+        """Stands in for a miner: each job blocks until released or cancelled"""
+        def __init__(self):
+            self.started = threading.Semaphore(0)
+            self.release = threading.Event()
+            self.cancelled = threading.Event()
+
+        def reset(self):
+            self.cancelled.clear()
+
+        def cancel(self):
+            self.cancelled.set()
+
+        def mine(self):
+            self.started.release()
+            while not self.release.wait(0.01):
+                if self.cancelled.is_set():
+                    raise MiningCancelled("Mining was cancelled")
+            if outcomes:
+                raise outcomes.pop()
+            return {'index': 1}
+
+    outcomes = []
+    miner = GatedMiner()
+    scheduler = MiningScheduler(miner.mine, lambda: 0, miner)
+
+    first = scheduler.submit()
+    assert miner.started.acquire(timeout=5)
+    assert scheduler.job(first['id'])['status'] == 'running'
+
+    # While one job runs, submits share the single queued job
+    second = scheduler.submit()
+    assert second['status'] == 'queued' and scheduler.submit()['id'] == second['id']
+    assert scheduler.cancel(second['id'])['status'] == 'cancelled'
+    assert scheduler.wait(second['id'], timeout=5)['status'] == 'cancelled'
+
+    # Cancelling the running job stops its miner
+    scheduler.cancel(first['id'])
+    first = scheduler.wait(first['id'], timeout=5)
+    assert first['status'] == 'cancelled' and first['started_at'] and first['finished_at']
+
+    miner.release.set()
+    done = scheduler.wait(scheduler.submit()['id'], timeout=5)
+    assert done['status'] == 'done' and done['result'] == {'index': 1}
+
+    outcomes.append(Exception("No pending transactions to mine"))
+    failed = scheduler.wait(scheduler.submit()['id'], timeout=5)
+    assert failed['status'] == 'failed' and failed['error'] == "No pending transactions to mine"
+    assert scheduler.job(second['id'])['started_at'] is None
+    assert scheduler.cancel('missing') is None and scheduler.job('missing') is None
+
+    with api_client() as (main, client):
+        assert client.post('/mine').status_code == 400
+        client.post('/transaction', json={'sender': 'alice', 'receiver': 'bob', 'amount': 1})
+        mined = client.post('/mine?wait=1').get_json()
+        assert mined['block']['content']['index'] == 1 and mined['remaining_pending'] == 0
+        assert client.get(f"/mine/{mined['job_id']}").get_json()['job']['status'] == 'done'
+        assert client.get('/mine/missing').status_code == 404
+        assert client.post('/mine/missing/cancel').status_code == 404
+
+def test_slotted_objects_round_trip():
+    from transaction import Transaction
+    from blockchain import Block, BlockHeader, makeGenesisBlock, blockHeader
+
+    transactions = [
+        {'transaction': {'alice': 100, 'bob': 100}, 'publicKey': None, 'signature': None},
+        {'transaction': {'alice': -5, 'bob': 5}, 'publicKey': 'pk', 'signature': 'sig',
+         'timestamp': '2024-01-01T00:00:00', 'fee': 0},
+        {'transaction': {'bob': -1, 'carol': 1}, 'publicKey': 'pk', 'signature': 'sig', 'timestamp': None, 'memo': 'x'}
+    ]
+    from storage import transaction_rows, pending_record_json
+
+    for signed in transactions:
+        transaction = Transaction.fromDict(signed)
+        assert transaction.toDict() == signed
+        assert transaction.txid() == hashMessage(signed)
+        # The encodings a Transaction keeps match encoding the dict afresh
+        record = {'op': 'add', 'id': transaction.txid()}
+        assert pending_record_json(dict(record, tx=transaction)) == pending_record_json(dict(record, tx=signed))
+        assert list(transaction_rows([transaction])) == list(transaction_rows([signed]))
+
+    block = makeGenesisBlock(transactions, difficulty=1, timestamp='2024-01-01T00:00:00')
+    assert Block.fromDict(block).toDict() == block
+    assert BlockHeader.fromDict(block).toDict() == blockHeader(block)
+
+def test_chain_state_views_are_immutable_snapshots():
+    from chainstate import ChainStateManager
+
+    state = {'alice': 100, 'bob': 100}
+    users = {'alice': {'public_key': 'pa'}, 'bob': {'public_key': 'pb'}}
+    manager = ChainStateManager([{'hash': 'h0'}], state, users)
+    with manager.lock:
+        view = manager.publish()
+        state['alice'] -= 10
+        state['bob'] += 10
+        users['carol'] = {'public_key': 'pc'}
+    assert dict(view.state) == {'alice': 100, 'bob': 100} and 'carol' not in view.users
+    assert view.length == 1 and view.tipHash == 'h0'
+
+    with manager.lock:
+        latest = manager.publish(usersChanged=False)
+    assert latest.state['alice'] == 90 and latest.users is view.users
+    try:
+        latest.state['alice'] = 0
+        assert False, "published state should be read-only"
+    except TypeError:
+        pass
+
 if __name__ == "__main__":
-    test_basic_functionality()
\ No newline at end of file
+    test_basic_functionality()
+    test_parallel_miner()
+    test_miner_cancel()
+    test_nonce_hasher_matches_hash_message()
+    test_state_overlay_rollback()
+    test_incremental_validation_from_checkpoint()
+    test_parallel_validation_reports_same_block()
+    test_transaction_changed_after_signing_is_rejected()
+    test_mempool_tracks_sender_spend()
+    test_block_template_compacts_and_unparks()
+    test_merkle_proofs_and_header_hash()
+    test_block_log_migration_append_and_torn_tail()
+    test_block_log_truncates_corrupt_tail()
+    test_pending_journal_replay_and_compaction()
+    test_reindex_resumes_and_fills_difficulty()
+    test_balance_at_each_height()
+    test_history_stream_matches_pages()
+    test_snapshot_load_replays_later_blocks()
+    test_blocks_api_ranges_and_headers()
+    test_transaction_batch_api()
+    test_mining_scheduler_jobs()
+    test_slotted_objects_round_trip()
+    test_chain_state_views_are_immutable_snapshots()
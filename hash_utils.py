@@ -1,5 +1,24 @@
+import hashlib
+import json
+
+# Same output as json.dumps(message, sort_keys=True), without building an encoder per call
+_encoder = json.JSONEncoder(sort_keys=True)
+
+def canonicalJson(message):
+    if type(message) == str:
+        return message
+    return _encoder.encode(message)
+
 def hashMessage(message):
-    import hashlib, json
-    if type(message) != str:
-        message = json.dumps(message, sort_keys=True)
-    return hashlib.sha256(str(message).encode('utf-8')).hexdigest()
\ No newline at end of file
+    return hashlib.sha256(canonicalJson(message).encode('utf-8')).hexdigest()
+
+def splitMessage(message, key):
+    """Canonical encoding of a dict split around the value of key, as (prefix, suffix) bytes"""
+    if key not in message:
+        raise KeyError(key)
+    before = [k for k in sorted(message) if k < key]
+    after = [k for k in sorted(message) if k > key]
+    encode = lambda k: json.dumps(k) + ': ' + _encoder.encode(message[k])
+    prefix = '{' + ''.join(encode(k) + ', ' for k in before) + json.dumps(key) + ': '
+    suffix = ''.join(', ' + encode(k) for k in after) + '}'
+    return prefix.encode('utf-8'), suffix.encode('utf-8')
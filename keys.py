@@ -1,15 +1,12 @@
 import hashlib
-from user import user_db
+from user import public_key_index
 
 def signMessage(message, priv_key):
     return hashlib.sha256((message + priv_key).encode()).hexdigest()
 
 def verifySign(message, signature, pub_key):
-    for user_info in user_db.values():
-        priv_key = user_info['private_key']
-        expected_public = hashlib.sha256(priv_key.encode()).hexdigest()
-        if expected_public == pub_key:
-            expected_sign = hashlib.sha256((message + priv_key).encode()).hexdigest()
-            return expected_sign == signature
-    return False
-        
\ No newline at end of file
+    priv_key = public_key_index.get(pub_key)
+    if priv_key is None:
+        return False
+    expected_sign = hashlib.sha256((message + priv_key).encode()).hexdigest()
+    return expected_sign == signature
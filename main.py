@@ -1,58 +1,125 @@
-from flask import Flask, jsonify, request
-import json, random
+from flask import Flask, Response, jsonify, request
+import json, os, random
 from datetime import datetime
 import atexit
 
-from transaction import makeTransaction
-from state import updateState, isValid
-from blockchain import makeBlock, checkBlockChain
-from user import generateKeys, user_db
-from hash_utils import hashMessage
+from transaction import makeTransaction, Transaction
+from state import StateOverlay, isValid
+from blockchain import makeBlock, makeGenesisBlock, checkBlockChain, blockHeader, MINING_DIFFICULTY
+from miner import ParallelMiner
+from user import generateKeys, loadUsers, user_db
+from hash_utils import canonicalJson
 from storage import BlockchainStorage
+from mempool import Mempool
+from blockstore import BlockStore
+from merkle import transactionHashes, merkleProof
+from template import BlockTemplate
+from scheduler import MiningScheduler
+from chainstate import ChainStateManager
 
 app = Flask(__name__)
 
 storage = BlockchainStorage()
+BLOCK_CACHE_BYTES = 64 * 1024 * 1024
 
-difficulty = 3
-blockChain = []
+difficulty = MINING_DIFFICULTY
+miner = ParallelMiner()
+blockChain = BlockStore(storage, BLOCK_CACHE_BYTES)
 current_state = {}
-pending_transactions = []
+mempool = Mempool()
+validation_checkpoint = None
+
+CHECKPOINT_INTERVAL = 1000
+VALIDATION_WORKERS = os.cpu_count()
+SNAPSHOT_INTERVAL = 1000
+MAX_BLOCK_TRANSACTIONS = 1000
+MAX_BLOCK_BYTES = 1000000
+BLOCK_PRIORITY = 'arrival'
+AUTO_MINE_PENDING = None
+MAX_BATCH_TRANSACTIONS = 10000
+AUTO_MINE_INTERVAL = None
+
+chain_state = ChainStateManager(blockChain, current_state, user_db)
+
+template = BlockTemplate(mempool, MAX_BLOCK_TRANSACTIONS, MAX_BLOCK_BYTES, BLOCK_PRIORITY)
 
 def save_all_data():
     """Save all data to persistent storage"""
-    storage.save_blockchain(blockChain)
-    storage.save_state(current_state)
-    storage.save_pending_transactions(pending_transactions)
+    with chain_state.lock:
+        storage.save_blockchain(blockChain)
+        storage.save_state(current_state)
+        storage.save_pending_transactions(list(mempool))
+        save_snapshot()
+
+def save_snapshot():
+    """Snapshot state and users at the current tip so startup only replays later blocks"""
+    if len(blockChain):
+        storage.save_snapshot(len(blockChain) - 1, blockChain.blockHash(-1), current_state, dict(user_db))
+
+def load_snapshot():
+    """Load the snapshot and index the block log after it; None if there is no usable snapshot"""
+    snapshot = storage.load_snapshot()
+    if snapshot:
+        try:
+            storage.scan_block_log(snapshot['offsets'], snapshot['hashes'], snapshot['log_size'])
+            height = snapshot['height']
+            # The hash array came from the snapshot too, so check the tip against the log itself
+            if len(blockChain) > height and storage.read_block(height)['hash'] == snapshot['tip_hash']:
+                return snapshot
+        except Exception as e:
+            print(f"Error reading block log after snapshot: {e}")
+        print("Snapshot does not match the block log, ignoring it")
+    storage.scan_block_log()
+    return None
 
 def load_all_data():
     """Load all data from persistent storage"""
-    global blockChain, current_state, pending_transactions, user_db
-    
-    loaded_users = storage.load_users()
-    if loaded_users:
-        user_db.update(loaded_users)
-        print(f"Loaded {len(loaded_users)} users from database")
+    snapshot = load_snapshot()
+    print(f"Indexed blockchain with {len(blockChain)} blocks")
     
-    loaded_blockchain = storage.load_blockchain()
-    if loaded_blockchain:
-        blockChain = loaded_blockchain
-        print(f"Loaded blockchain with {len(blockChain)} blocks")
+    indexed = storage.balances_height()
+    if indexed < len(blockChain) - 1:
+        storage.save_block_balances(blockChain.iterBlocks(indexed + 1))
+        print(f"Indexed balances from block {indexed + 1}")
     
-    loaded_state = storage.load_state()
-    if loaded_state:
-        current_state.update(loaded_state)
-        print(f"Loaded state for {len(loaded_state)} users")
+    if snapshot:
+        loadUsers(snapshot['users'])
+        loadUsers(storage.load_users(snapshot['users_rowid']))
+        print(f"Loaded {len(user_db)} users from snapshot and database")
+        
+        current_state.update(snapshot['state'])
+        replayed = 0
+        for block in blockChain.iterBlocks(snapshot['height'] + 1):
+            for transaction in block['content']['transactions']:
+                for key, value in transaction['transaction'].items():
+                    current_state[key] = current_state.get(key, 0) + value
+            replayed += 1
+        for username in user_db:
+            current_state.setdefault(username, 0)
+        print(f"Loaded state at height {snapshot['height']} and replayed {replayed} blocks")
+    else:
+        loaded_users = storage.load_users()
+        if loaded_users:
+            loadUsers(loaded_users)
+            print(f"Loaded {len(loaded_users)} users from database")
+        
+        loaded_state = storage.load_state()
+        if loaded_state:
+            current_state.update(loaded_state)
+            print(f"Loaded state for {len(loaded_state)} users")
     
     loaded_pending = storage.load_pending_transactions()
     if loaded_pending:
-        pending_transactions.extend(loaded_pending)
+        for transaction in loaded_pending:
+            mempool.add(transaction)
+        template.rebuild()
         print(f"Loaded {len(loaded_pending)} pending transactions")
+    
+    with chain_state.lock:
+        chain_state.publish()
 
 def initialize_blockchain():
     """Initialize the blockchain with genesis block"""
-    global blockChain, current_state
-    
     load_all_data()
     
     if not blockChain:
@@ -70,33 +137,19 @@ def initialize_blockchain():
             'signature': None
         }
 
-        genesisBlockTransactions = [genesisTransaction]
-        genesisBlockContent = {
-            'index': 0,
-            'parentHash': None,
-            'transactionCount': 1,
-            'transactions': genesisBlockTransactions,
-            'nonce': 0,
-            'timestamp': datetime.now().isoformat()
-        }
-
         print("Mining genesis block...")
-        while True:
-            genesisBlockHash = hashMessage(genesisBlockContent)
-            if genesisBlockHash.startswith('0' * difficulty):
-                break
-            genesisBlockContent['nonce'] += 1
-
-        genesisBlock = {
-            'hash': genesisBlockHash,
-            'content': genesisBlockContent
-        }
+        genesisBlock = makeGenesisBlock(
+            [genesisTransaction], difficulty, miner,
+            timestamp=datetime.now().isoformat()
+        )
         
-        blockChain = [genesisBlock]
-        current_state = genesisTransaction['transaction'].copy()
+        blockChain.append(genesisBlock)
+        current_state.update(genesisTransaction['transaction'])
         
         storage.save_block_metadata(genesisBlock, difficulty)
         
+        with chain_state.lock:
+            chain_state.publish()
         save_all_data()
         print("Genesis block created and saved!")
 
@@ -107,28 +160,34 @@ def home():
         "message": "Blockchain API with Persistent Storage",
         "endpoints": {
             "GET /": "This help message",
-            "GET /blockchain": "Get the full blockchain",
+            "GET /blockchain": "Get the full blockchain (streamed)",
+            "GET /blocks": "Get blocks in a range ?from&to&headers=1",
             "GET /blockchain/length": "Get blockchain length",
             "GET /blockchain/stats": "Get blockchain statistics",
             "GET /block/<int:index>": "Get specific block by index",
-            "GET /balance/<username>": "Get user balance",
+            "GET /block/<int:index>/proof/<tx>": "Merkle inclusion proof for a transaction (id or position)",
+            "GET /balance/<username>": "Get user balance (?height=N for the balance after block N)",
+            "GET /balances": "Get balances after a block ?height&users=alice,bob",
             "GET /state": "Get current blockchain state",
             "GET /users": "Get all users",
             "GET /pending": "Get pending transactions",
-            "GET /transactions": "Get transaction history",
-            "GET /transactions/<username>": "Get user transaction history",
+            "GET /transactions": "Get transaction history ?limit&before_id&after_id&from_block&to_block&since&until&format=ndjson",
+            "GET /transactions/<username>": "Get user transaction history (same query parameters)",
             "POST /users": "Create new user {username}",
-            "POST /transaction": "Create transaction {sender, receiver, amount}",
-            "POST /mine": "Mine pending transactions into a new block",
-            "POST /validate": "Validate the entire blockchain",
+            "POST /transaction": "Create transaction {sender, receiver, amount, fee?}",
+            "POST /transactions/batch": "Create many transactions [{sender, receiver, amount, fee?}, ...]",
+            "POST /mine": "Queue a mining job for pending transactions (?wait=1 to wait for the block)",
+            "GET /mine/<job_id>": "Get mining job status",
+            "POST /mine/<job_id>/cancel": "Cancel a mining job",
+            "POST /validate": "Validate blocks added since the last checkpoint (?full=1 for the entire blockchain)",
             "POST /backup": "Create data backup",
             "POST /save": "Force save all data"
         },
         "storage_info": {
             "database_file": "blockchain.db",
-            "blockchain_file": "blockchain.json",
+            "blockchain_file": "blockchain.log",
             "state_file": "state.json",
-            "pending_file": "pending_transactions.json"
+            "pending_file": "pending_transactions.log"
         }
     })
 
@@ -137,33 +196,56 @@ def get_blockchain_stats():
     """Get blockchain statistics"""
     stats = storage.get_blockchain_stats()
     stats.update({
-        "current_block_height": len(blockChain) - 1,
-        "pending_transactions": len(pending_transactions),
-        "active_users": len(user_db),
-        "difficulty": difficulty
+        "current_block_height": chain_state.view.length - 1,
+        "pending_transactions": len(mempool),
+        "active_users": len(chain_state.view.users),
+        "difficulty": difficulty,
+        "block_cache": blockChain.cacheStats()
     })
     return jsonify(stats)
 
-@app.route('/transactions', methods=['GET'])
-def get_all_transactions():
-    """Get transaction history"""
+def history_filters():
+    """Read keyset pagination and range filters from the query string"""
+    return {
+        "before_id": request.args.get('before_id', type=int),
+        "after_id": request.args.get('after_id', type=int),
+        "from_block": request.args.get('from_block', type=int),
+        "to_block": request.args.get('to_block', type=int),
+        "since": request.args.get('since'),
+        "until": request.args.get('until')
+    }
+
+def history_response(username=None):
+    """Return one history page as JSON, or stream every matching row as NDJSON"""
+    filters = history_filters()
+    if request.args.get('format') == 'ndjson':
+        limit = request.args.get('limit', type=int)
+        rows = storage.iter_transaction_history(username=username, limit=limit, **filters)
+        return Response((json.dumps(row) + '\n' for row in rows), mimetype='application/x-ndjson')
+    
     limit = request.args.get('limit', 50, type=int)
-    transactions = storage.get_transaction_history(limit=limit)
-    return jsonify({
+    transactions = storage.get_transaction_history(username=username, limit=limit, **filters)
+    response = {
         "transactions": transactions,
         "count": len(transactions)
-    })
+    }
+    if username:
+        response = {"username": username, **response}
+    if transactions:
+        ids = [tx['id'] for tx in transactions]
+        response["next_before_id"] = min(ids)
+        response["next_after_id"] = max(ids)
+    return jsonify(response)
+
+@app.route('/transactions', methods=['GET'])
+def get_all_transactions():
+    """Get transaction history"""
+    return history_response()
 
 @app.route('/transactions/<username>', methods=['GET'])
 def get_user_transactions(username):
     """Get user transaction history"""
-    limit = request.args.get('limit', 50, type=int)
-    transactions = storage.get_transaction_history(username=username, limit=limit)
-    return jsonify({
-        "username": username,
-        "transactions": transactions,
-        "count": len(transactions)
-    })
+    return history_response(username)
 
 @app.route('/backup', methods=['POST'])
 def create_backup():
@@ -182,50 +264,136 @@ def force_save():
     except Exception as e:
         return jsonify({"error": f"Save failed: {str(e)}"}), 500
 
+def stream_blocks(key, start, stop, headers_only=False, **extra):
+    """Stream {key: [blocks start..stop-1], **extra} one block at a time"""
+    def generate():
+        yield '{"%s": [' % key
+        for index in range(start, stop):
+            block = blockChain[index]
+            if headers_only:
+                block = blockHeader(block)
+            yield (', ' if index > start else '') + json.dumps(block, sort_keys=True)
+        yield ']'
+        for name, value in sorted(extra.items()):
+            yield ', %s: %s' % (json.dumps(name), json.dumps(value))
+        yield '}\n'
+    return Response(generate(), mimetype='application/json')
+
 @app.route('/blockchain', methods=['GET'])
 def get_blockchain():
     """Get the full blockchain"""
-    return jsonify({
-        "blockchain": blockChain,
-        "length": len(blockChain)
-    })
+    length = chain_state.view.length
+    return stream_blocks("blockchain", 0, length, length=length)
+
+@app.route('/blocks', methods=['GET'])
+def get_blocks():
+    """Get a range of blocks, optionally headers only"""
+    length = chain_state.view.length
+    start = request.args.get('from', 0, type=int)
+    end = request.args.get('to', type=int)
+    if end is None:
+        end = max(start, length - 1)
+    headers_only = request.args.get('headers', '').lower() in ('1', 'true', 'yes')
+    if start < 0 or end < start:
+        return jsonify({"error": "Invalid block range"}), 400
+    
+    start = min(start, length)
+    stop = min(end + 1, length)
+    return stream_blocks("blocks", start, stop, headers_only, **{"from": start, "to": stop - 1, "length": length})
 
 @app.route('/blockchain/length', methods=['GET'])
 def get_blockchain_length():
     """Get blockchain length"""
-    return jsonify({"length": len(blockChain)})
+    return jsonify({"length": chain_state.view.length})
 
 @app.route('/block/<int:index>', methods=['GET'])
 def get_block(index):
     """Get specific block by index"""
-    if index < 0 or index >= len(blockChain):
+    if index < 0 or index >= chain_state.view.length:
         return jsonify({"error": "Block index out of range"}), 404
     
     return jsonify({"block": blockChain[index]})
 
+@app.route('/block/<int:index>/proof/<tx>', methods=['GET'])
+def get_transaction_proof(index, tx):
+    """Merkle inclusion proof for a transaction, given its id or position in the block"""
+    if index < 0 or index >= chain_state.view.length:
+        return jsonify({"error": "Block index out of range"}), 404
+    
+    block = blockChain[index]
+    content = block['content']
+    if 'merkleRoot' not in content:
+        return jsonify({"error": f"Block {index} predates merkle roots"}), 400
+    
+    leaves = transactionHashes(content['transactions'])
+    if tx.isdigit():
+        position = int(tx)
+    elif tx in leaves:
+        position = leaves.index(tx)
+    else:
+        position = -1
+    if not 0 <= position < len(leaves):
+        return jsonify({"error": "Transaction not found in block"}), 404
+    
+    return jsonify({
+        "block_index": index,
+        "header": blockHeader(block),
+        "merkle_root": content['merkleRoot'],
+        "txid": leaves[position],
+        "position": position,
+        "transaction": content['transactions'][position],
+        "proof": merkleProof(leaves, position)
+    })
+
 @app.route('/balance/<username>', methods=['GET'])
 def get_balance(username):
-    """Get user balance"""
-    balance = current_state.get(username, 0)
+    """Get user balance, optionally as of a block height"""
+    view = chain_state.view
+    height = request.args.get('height', type=int)
+    if height is None:
+        return jsonify({
+            "username": username,
+            "balance": view.state.get(username, 0)
+        })
+    
+    if height < 0 or height >= view.length:
+        return jsonify({"error": "Block height out of range"}), 404
     return jsonify({
         "username": username,
-        "balance": balance
+        "height": height,
+        "balance": storage.get_balance_at(username, height)
+    })
+
+@app.route('/balances', methods=['GET'])
+def get_balances():
+    """Get balances of many accounts after a block; all accounts if users is omitted"""
+    length = chain_state.view.length
+    height = request.args.get('height', length - 1, type=int)
+    if height < 0 or height >= length:
+        return jsonify({"error": "Block height out of range"}), 404
+    
+    users = request.args.get('users')
+    usernames = [name for name in users.split(',') if name] if users else None
+    return jsonify({
+        "height": height,
+        "balances": storage.get_balances_at(usernames, height)
     })
 
 @app.route('/state', methods=['GET'])
 def get_state():
     """Get current blockchain state"""
-    return jsonify({"state": current_state})
+    return jsonify({"state": dict(chain_state.view.state)})
 
 @app.route('/users', methods=['GET'])
 def get_users():
     """Get all users"""
+    view = chain_state.view
     users = []
-    for username in user_db:
+    for username, public_key in view.users.items():
         users.append({
             "username": username,
-            "balance": current_state.get(username, 0),
-            "public_key": user_db[username]['public_key']
+            "balance": view.state.get(username, 0),
+            "public_key": public_key
         })
     return jsonify({"users": users})
 
@@ -237,14 +405,16 @@ def create_user():
         return jsonify({"error": "Username required"}), 400
     
     username = data['username']
-    if username in user_db:
-        return jsonify({"error": "User already exists"}), 400
-    
-    priv_key, pub_key = generateKeys(username)
-    current_state[username] = 0
-    
-    storage.save_user(username, priv_key, pub_key)
-    save_all_data()
+    with chain_state.lock:
+        if username in user_db:
+            return jsonify({"error": "User already exists"}), 400
+        
+        priv_key, pub_key = generateKeys(username)
+        current_state[username] = 0
+        
+        storage.save_user(username, priv_key, pub_key)
+        storage.save_state(current_state)
+        chain_state.publish()
     
     return jsonify({
         "message": f"User {username} created successfully",
@@ -256,118 +426,254 @@ def create_user():
 @app.route('/pending', methods=['GET'])
 def get_pending_transactions():
     """Get pending transactions"""
+    with chain_state.lock:
+        pending = mempool.toDicts()
     return jsonify({
-        "pending_transactions": pending_transactions,
-        "count": len(pending_transactions)
+        "pending_transactions": pending,
+        "count": len(pending)
     })
 
-@app.route('/transaction', methods=['POST'])
-def create_transaction():
-    """Create a new transaction"""
-    data = request.get_json()
-    if not data or not all(k in data for k in ('sender', 'receiver', 'amount')):
-        return jsonify({"error": "sender, receiver, and amount required"}), 400
+def sign_transfer(data):
+    """Check a {sender, receiver, amount, fee?} request and sign it; returns (signed_transaction, error)"""
+    if not isinstance(data, dict) or not all(k in data for k in ('sender', 'receiver', 'amount')):
+        return None, "sender, receiver, and amount required"
     
     sender = data['sender']
     receiver = data['receiver']
     amount = data['amount']
+    fee = data.get('fee', 0)
 
-    if sender not in user_db:
-        return jsonify({"error": f"Sender {sender} does not exist"}), 400
+    users = chain_state.view.users
+    if sender not in users:
+        return None, f"Sender {sender} does not exist"
+    
+    if receiver not in users:
+        return None, f"Receiver {receiver} does not exist"
+    
+    if not isinstance(amount, (int, float)) or amount <= 0:
+        return None, "Amount must be positive"
+    
+    if not isinstance(fee, (int, float)) or fee < 0:
+        return None, "Fee must be a non-negative number"
     
-    if receiver not in user_db:
-        return jsonify({"error": f"Receiver {receiver} does not exist"}), 400
+    transaction = {sender: -amount, receiver: amount}
+    message = canonicalJson(transaction)
     
-    if amount <= 0:
-        return jsonify({"error": "Amount must be positive"}), 400
+    from user import getPrivateKey, getPublicKey
+    from keys import signMessage
     
-    if current_state.get(sender, 0) < amount:
-        return jsonify({"error": "Insufficient balance"}), 400
+    priv_key = getPrivateKey(sender)
+    pub_key = getPublicKey(sender)
+    signature = signMessage(message, priv_key)
     
+    signed_transaction = {
+        'transaction': transaction,
+        'publicKey': pub_key,
+        'signature': signature,
+        'timestamp': datetime.now().isoformat()
+    }
+    if fee:
+        signed_transaction['fee'] = fee
+    return signed_transaction, None
+
+def admit_transaction(signed_transaction):
+    """Add a signed transaction to the mempool and template; caller holds chain_state.lock and journals it"""
+    if not mempool.canAfford(current_state, signed_transaction['transaction']):
+        return None, "Insufficient balance"
+    # Encoded once here and reused for the template, the journal, the block rows and the merkle root
+    pending = Transaction.fromDict(signed_transaction)
+    if not isValid(current_state, pending):
+        return None, "Invalid transaction"
+    
+    txid = mempool.add(pending)
+    template.add(txid, mempool.get(txid))
+    return txid, None
+
+@app.route('/transaction', methods=['POST'])
+def create_transaction():
+    """Create a new transaction"""
     try:
-        transaction = {sender: -amount, receiver: amount}
-        message = json.dumps(transaction, sort_keys=True)
-        
-        from user import getPrivateKey, getPublicKey
-        from keys import signMessage
+        signed_transaction, error = sign_transfer(request.get_json())
+        if error:
+            return jsonify({"error": error}), 400
         
-        priv_key = getPrivateKey(sender)
-        pub_key = getPublicKey(sender)
-        signature = signMessage(message, priv_key)
+        with chain_state.lock:
+            txid, error = admit_transaction(signed_transaction)
+            if error:
+                return jsonify({"error": error}), 400
+            storage.append_pending(mempool.get(txid), txid)
         
-        signed_transaction = {
-            'transaction': transaction,
-            'publicKey': pub_key,
-            'signature': signature,
-            'timestamp': datetime.now().isoformat()
-        }
-        
-        if isValid(current_state, signed_transaction):
-            pending_transactions.append(signed_transaction)
-            save_all_data()
-            return jsonify({
-                "message": "Transaction created and added to pending pool",
-                "transaction": signed_transaction
-            })
-        else:
-            return jsonify({"error": "Invalid transaction"}), 400
+        scheduler.notify()
+        return jsonify({
+            "message": "Transaction created and added to pending pool",
+            "transaction": signed_transaction
+        })
             
     except Exception as e:
         return jsonify({"error": f"Transaction creation failed: {str(e)}"}), 500
 
-@app.route('/mine', methods=['POST'])
-def mine_block():
-    """Mine pending transactions into a new block"""
-    global current_state, pending_transactions
-    
-    if not pending_transactions:
-        return jsonify({"error": "No pending transactions to mine"}), 400
+@app.route('/transactions/batch', methods=['POST'])
+def create_transaction_batch():
+    """Create many transactions, validated against one running state and journaled together"""
+    data = request.get_json()
+    transfers = data.get('transactions') if isinstance(data, dict) else data
+    if not isinstance(transfers, list) or not transfers:
+        return jsonify({"error": "A non-empty array of transactions is required"}), 400
+    if len(transfers) > MAX_BATCH_TRANSACTIONS:
+        return jsonify({"error": f"At most {MAX_BATCH_TRANSACTIONS} transactions per batch"}), 400
     
-    valid_transactions = []
-    temp_state = current_state.copy()
+    try:
+        signed = [sign_transfer(transfer) for transfer in transfers]
+        
+        results = []
+        accepted = []
+        with chain_state.lock:
+            for index, (signed_transaction, error) in enumerate(signed):
+                if not error:
+                    txid, error = admit_transaction(signed_transaction)
+                if error:
+                    results.append({"index": index, "status": "rejected", "error": error})
+                else:
+                    accepted.append((txid, mempool.get(txid)))
+                    results.append({"index": index, "status": "accepted", "transaction": signed_transaction})
+            if accepted:
+                storage.append_pending_batch(accepted)
+        
+        scheduler.notify()
+        return jsonify({
+            "accepted": len(accepted),
+            "rejected": len(results) - len(accepted),
+            "results": results
+        })
     
-    for transaction in pending_transactions:
-        if isValid(temp_state, transaction):
-            valid_transactions.append(transaction)
-            temp_state = updateState(temp_state, transaction['transaction'])
+    except Exception as e:
+        return jsonify({"error": f"Batch creation failed: {str(e)}"}), 500
+
+def mine_pending_block():
+    """Build a block from the template, mine it outside the lock and commit it under chain_state.lock"""
+    with chain_state.lock:
+        if not mempool:
+            raise Exception("No pending transactions to mine")
+        
+        valid_transactions = []
+        valid_pending = []
+        valid_ids = []
+        stale_ids = []
+        overlay = StateOverlay(current_state)
+        
+        # Signatures were verified when the transactions entered the mempool
+        for txid, pending in template.transactions():
+            transaction = pending.toDict()
+            if isValid(overlay, transaction, checkSignature=False):
+                valid_transactions.append(transaction)
+                valid_pending.append(pending)
+                valid_ids.append(txid)
+                overlay.apply(transaction['transaction'])
+            else:
+                stale_ids.append(txid)
+        
+        for txid in stale_ids:
+            template.park(txid)
+        template.fill()
+        
+        if not valid_transactions:
+            raise Exception("No valid transactions to mine")
     
-    if not valid_transactions:
-        return jsonify({"error": "No valid transactions to mine"}), 400
+    # Only the scheduler thread commits blocks, so the tip cannot move while mining
+    block = makeBlock(blockChain, valid_transactions, difficulty, miner, txids=valid_ids)
     
-    try:
-        block = makeBlock(blockChain, valid_transactions, difficulty)
+    with chain_state.lock:
         blockChain.append(block)
         
-        storage.save_block_metadata(block, difficulty)
+        storage.save_block_metadata(block, difficulty, valid_pending)
         
-        for transaction in valid_transactions:
-            current_state = updateState(current_state, transaction['transaction'])
+        overlay.commit()
+        storage.save_state(current_state)
+        chain_state.publish(usersChanged=False)
         
-        for transaction in valid_transactions:
-            if transaction in pending_transactions:
-                pending_transactions.remove(transaction)
+        for txid in valid_ids:
+            mempool.remove(txid)
+            template.discard(txid)
+        # Parked transactions failed against the old balances; offer back those that apply now
+        template.unpark([
+            txid for txid in list(template.parked)
+            if txid not in mempool or isValid(current_state, mempool.get(txid), checkSignature=False)
+        ])
+        template.fill()
+        storage.remove_pending(valid_ids)
         
-        save_all_data()
+        if block['content']['index'] % SNAPSHOT_INTERVAL == 0:
+            save_snapshot()
         
-        return jsonify({
+        return {
             "message": f"Block mined successfully with {len(valid_transactions)} transactions",
             "block": block,
             "transactions_mined": len(valid_transactions),
-            "remaining_pending": len(pending_transactions)
-        })
-        
-    except Exception as e:
-        return jsonify({"error": f"Mining failed: {str(e)}"}), 500
+            "remaining_pending": len(mempool)
+        }
+
+scheduler = MiningScheduler(mine_pending_block, lambda: len(mempool), miner,
+                            AUTO_MINE_PENDING, AUTO_MINE_INTERVAL)
+
+@app.route('/mine', methods=['POST'])
+def mine_block():
+    """Queue a mining job; ?wait=1 blocks until it finishes"""
+    if not mempool:
+        return jsonify({"error": "No pending transactions to mine"}), 400
+    
+    job = scheduler.submit()
+    if request.args.get('wait', '').lower() not in ('1', 'true', 'yes'):
+        return jsonify({"job_id": job['id'], "status": job['status']}), 202
+    
+    job = scheduler.wait(job['id'])
+    if job['status'] == 'done':
+        return jsonify({"job_id": job['id'], **job['result']})
+    return jsonify({"job_id": job['id'], "status": job['status'], "error": job['error']}), 500
+
+@app.route('/mine/<job_id>', methods=['GET'])
+def get_mining_job(job_id):
+    """Get the status of a mining job"""
+    job = scheduler.job(job_id)
+    if job is None:
+        return jsonify({"error": "Mining job not found"}), 404
+    return jsonify({"job": job})
+
+@app.route('/mine/<job_id>/cancel', methods=['POST'])
+def cancel_mining_job(job_id):
+    """Cancel a queued or running mining job"""
+    job = scheduler.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "Mining job not found"}), 404
+    return jsonify({"job": job})
 
 @app.route('/validate', methods=['POST'])
 def validate_blockchain():
-    """Validate the entire blockchain"""
+    """Validate blocks added since the last checkpoint, or the entire blockchain with ?full=1"""
+    global validation_checkpoint
+    
+    full = request.args.get('full', '').lower() in ('1', 'true', 'yes')
     try:
-        chain_json = json.dumps(blockChain, sort_keys=True)
-        final_state = checkBlockChain(chain_json, difficulty)
+        checkpoint = None
+        if not full:
+            checkpoint = validation_checkpoint or storage.load_latest_checkpoint(len(blockChain) - 1)
+        
+        checkpoints = []
+        
+        def on_checkpoint(reached):
+            storage.save_checkpoint(reached)
+            checkpoints.append(reached)
+        
+        final_state = checkBlockChain(blockChain, difficulty, checkpoint, on_checkpoint, CHECKPOINT_INTERVAL,
+                                      workers=VALIDATION_WORKERS)
+        if checkpoints:
+            validation_checkpoint = checkpoints[-1]
+        
+        validated_from = checkpoint['height'] + 1 if checkpoint else 0
         return jsonify({
             "valid": True,
             "message": "Blockchain is valid",
+            "validated_from": validated_from,
+            "blocks_checked": len(blockChain) - validated_from,
             "final_state": final_state
         })
     except Exception as e:
@@ -388,6 +694,7 @@ atexit.register(save_all_data)
 
 if __name__ == '__main__':
     initialize_blockchain()
+    scheduler.start()
     print("Blockchain with persistent storage initialized successfully!")
     print("Starting Flask API server...")
     print("Access the API at http://localhost:5000")
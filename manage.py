@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Maintenance commands for the blockchain data files
+
+Usage: python manage.py <command> [--database FILE] [options]
+
+Run these with the server stopped.
+"""
+
+import argparse
+import time
+
+from storage import BlockchainStorage, DATABASE_FILE
+from blockchain import MINING_DIFFICULTY
+
+def rebuild_stats(storage, args):
+    """Recompute the materialized chain statistics from the blocks and transactions tables"""
+    start = time.perf_counter()
+    storage.rebuild_stats()
+    stats = storage.get_blockchain_stats()
+    print(f"Rebuilt stats for {stats['block_count']} blocks and {stats['transaction_count']} transactions "
+          f"in {time.perf_counter() - start:.2f}s")
+
+def reindex(storage, args):
+    """Rebuild the SQLite tables from the block log, resuming an interrupted run unless --restart is given"""
+    def report(blocks, rows, elapsed):
+        print(f"  {blocks} blocks, {rows} rows, {rows / elapsed if elapsed else 0:,.0f} rows/s")
+    
+    blocks, rows, elapsed = storage.reindex(args.difficulty, args.workers, args.batch_size,
+                                            resume=not args.restart, report=report,
+                                            default_difficulty=MINING_DIFFICULTY)
+    print(f"Reindexed {blocks} blocks ({rows} rows) in {elapsed:.2f}s, "
+          f"{rows / elapsed if elapsed else 0:,.0f} rows/s including index rebuild")
+
+COMMANDS = {
+    'rebuild-stats': rebuild_stats,
+    'reindex': reindex,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('command', choices=COMMANDS)
+    parser.add_argument('--database', default=DATABASE_FILE)
+    parser.add_argument('--difficulty', type=int, default=None,
+                        help="difficulty recorded for reindexed blocks (default: keep each block's, "
+                             f"or {MINING_DIFFICULTY} where none is recorded)")
+    parser.add_argument('--workers', type=int, default=None, help="parser processes (default: CPU count)")
+    parser.add_argument('--batch-size', type=int, default=1000, help="blocks per commit")
+    parser.add_argument('--restart', action='store_true', help="ignore saved reindex progress")
+    args = parser.parse_args()
+    COMMANDS[args.command](BlockchainStorage(args.database), args)
+
+if __name__ == "__main__":
+    main()
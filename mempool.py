@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from transaction import Transaction
+
+def senderSpends(transaction):
+    return {key: -value for key, value in transaction.items() if value < 0}
+
+class Mempool:
+    """Pending transactions keyed by hash, in arrival order, with per-sender queues and spend totals.
+
+    Entries are stored as Transaction objects; add() accepts either form.
+    """
+    def __init__(self, transactions=()):
+        self.transactions = OrderedDict()
+        self.bySender = {}
+        self.spending = {}
+        for transaction in transactions:
+            self.add(transaction)
+
+    def add(self, signedTransaction, txid=None):
+        if not isinstance(signedTransaction, Transaction):
+            signedTransaction = Transaction.fromDict(signedTransaction)
+        if txid is None:
+            txid = signedTransaction.txid()
+        if txid in self.transactions:
+            return txid
+        self.transactions[txid] = signedTransaction
+        for sender, amount in senderSpends(signedTransaction.transaction).items():
+            self.bySender.setdefault(sender, OrderedDict())[txid] = None
+            self.spending[sender] = self.spending.get(sender, 0) + amount
+        return txid
+
+    def remove(self, txid):
+        signedTransaction = self.transactions.pop(txid, None)
+        if signedTransaction is None:
+            return None
+        for sender, amount in senderSpends(signedTransaction.transaction).items():
+            queue = self.bySender[sender]
+            del queue[txid]
+            self.spending[sender] -= amount
+            if not queue:
+                del self.bySender[sender]
+                del self.spending[sender]
+        return signedTransaction
+
+    def get(self, txid):
+        return self.transactions.get(txid)
+
+    def pendingSpend(self, sender):
+        return self.spending.get(sender, 0)
+
+    def senderQueue(self, sender):
+        return [self.transactions[txid] for txid in self.bySender.get(sender, ())]
+
+    def canAfford(self, state, transaction):
+        """True if every sender still covers this transfer after their pending spends"""
+        for sender, amount in senderSpends(transaction).items():
+            if state.get(sender, 0) - self.pendingSpend(sender) < amount:
+                return False
+        return True
+
+    def toDicts(self):
+        """Pending transactions as plain dicts, for the API and the pending journal"""
+        return [transaction.toDict() for transaction in self.transactions.values()]
+
+    def items(self):
+        return self.transactions.items()
+
+    def __contains__(self, txid):
+        return txid in self.transactions
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def __iter__(self):
+        return iter(self.transactions.values())
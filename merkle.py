@@ -0,0 +1,54 @@
+import hashlib
+from hash_utils import hashMessage
+
+# Interior nodes are prefixed so they can never be confused with a transaction hash
+NODE_PREFIX = b'\x01'
+EMPTY_ROOT = hashlib.sha256(b'').hexdigest()
+
+def transactionHashes(transactions):
+    """Leaf hashes; these are the same ids the mempool uses for pending transactions"""
+    return [hashMessage(transaction) for transaction in transactions]
+
+def hashPair(left, right):
+    return hashlib.sha256(NODE_PREFIX + bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+def nextLevel(level):
+    """Hash adjacent pairs; an odd node at the end is carried up unchanged"""
+    paired = [hashPair(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+    if len(level) % 2:
+        paired.append(level[-1])
+    return paired
+
+def merkleRootFromHashes(leaves):
+    if not leaves:
+        return EMPTY_ROOT
+    level = list(leaves)
+    while len(level) > 1:
+        level = nextLevel(level)
+    return level[0]
+
+def merkleRoot(transactions):
+    return merkleRootFromHashes(transactionHashes(transactions))
+
+def merkleProof(leaves, position):
+    """Sibling hashes from leaf to root, each tagged with the side it sits on"""
+    if not 0 <= position < len(leaves):
+        raise IndexError("transaction position out of range")
+    proof = []
+    level = list(leaves)
+    while len(level) > 1:
+        sibling = position ^ 1
+        if sibling < len(level):
+            proof.append({'hash': level[sibling], 'side': 'left' if sibling < position else 'right'})
+        level = nextLevel(level)
+        position //= 2
+    return proof
+
+def verifyMerkleProof(leaf, proof, root):
+    current = leaf
+    for step in proof:
+        if step['side'] == 'left':
+            current = hashPair(step['hash'], current)
+        else:
+            current = hashPair(current, step['hash'])
+    return current == root
@@ -0,0 +1,152 @@
+import hashlib
+import multiprocessing
+import os
+from hash_utils import hashMessage, splitMessage
+
+class MiningCancelled(Exception):
+    pass
+
+class CancelToken:
+    """Cancellation for one mining job; stop is the running search's worker event, if any"""
+    __slots__ = ('cancelled', 'stop')
+
+    def __init__(self):
+        self.cancelled = False
+        self.stop = None
+
+    def cancel(self):
+        self.cancelled = True
+        if self.stop is not None:
+            self.stop.set()
+
+def nonceHasher(blockContent):
+    """Return hash(nonce) equal to hashMessage(blockContent) with that nonce, serializing the block once"""
+    prefix, suffix = splitMessage(blockContent, 'nonce')
+    prefixState = hashlib.sha256(prefix)
+
+    def hashNonce(nonce):
+        state = prefixState.copy()
+        state.update(b'%d' % nonce)
+        state.update(suffix)
+        return state.hexdigest()
+
+    return hashNonce
+
+def _searchNonces(prefix, suffix, difficulty, start, step, chunkSize, stop, result):
+    """Worker loop: scan nonce chunks start, start + step, ... until a hash is found or stop is set"""
+    prefixState = hashlib.sha256(prefix)
+    target = '0' * difficulty
+    base = start
+    while not stop.is_set():
+        for nonce in range(base, base + chunkSize):
+            state = prefixState.copy()
+            state.update(b'%d' % nonce)
+            state.update(suffix)
+            if state.hexdigest().startswith(target):
+                with result.get_lock():
+                    if result.value < 0:
+                        result.value = nonce
+                stop.set()
+                return
+        base += step
+
+class SerialMiner:
+    """Single-process proof-of-work search, checking for cancellation between chunks.
+
+    cancel() applies to the search in progress, or to the next mine() call if none is running,
+    so a job cancelled while its block is still being assembled never starts mining.
+    """
+    def __init__(self, chunkSize=10000):
+        self.chunkSize = chunkSize
+        self._token = CancelToken()
+
+    def reset(self):
+        """Start a new job, dropping any cancel left over from the previous one"""
+        self._token = CancelToken()
+
+    def mine(self, blockContent, difficulty=2):
+        token = self._token
+        try:
+            hashNonce = nonceHasher(blockContent)
+            target = '0' * difficulty
+            nonce = blockContent['nonce']
+            while not token.cancelled:
+                for nonce in range(nonce, nonce + self.chunkSize):
+                    blockHash = hashNonce(nonce)
+                    if blockHash.startswith(target):
+                        blockContent['nonce'] = nonce
+                        return blockHash
+                nonce += 1
+            raise MiningCancelled("Mining cancelled")
+        finally:
+            if self._token is token:
+                self.reset()
+
+    def cancel(self):
+        self._token.cancel()
+
+class ParallelMiner:
+    """Proof-of-work search split across worker processes by interleaved nonce ranges"""
+    def __init__(self, workers=None, chunkSize=10000):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunkSize = chunkSize
+        self._serial = SerialMiner(chunkSize)
+        self._token = CancelToken()
+
+    def reset(self):
+        """Start a new job, dropping any cancel left over from the previous one"""
+        self._token = CancelToken()
+        self._serial.reset()
+
+    def mine(self, blockContent, difficulty=2):
+        if self.workers <= 1:
+            return self._serial.mine(blockContent, difficulty)
+
+        token = self._token
+        token.stop = stop = multiprocessing.Event()
+        if token.cancelled:
+            stop.set()
+        result = multiprocessing.Value('q', -1)
+        firstNonce = blockContent['nonce']
+        prefix, suffix = splitMessage(blockContent, 'nonce')
+        step = self.workers * self.chunkSize
+
+        processes = [
+            multiprocessing.Process(
+                target=_searchNonces,
+                args=(prefix, suffix, difficulty, firstNonce + i * self.chunkSize,
+                      step, self.chunkSize, stop, result),
+                daemon=True
+            )
+            for i in range(self.workers)
+        ]
+        for process in processes:
+            process.start()
+
+        try:
+            while not stop.wait(0.05):
+                if not any(process.is_alive() for process in processes):
+                    break
+        finally:
+            stop.set()
+            for process in processes:
+                process.join(1)
+                if process.is_alive():
+                    process.terminate()
+            token.stop = None
+            if self._token is token:
+                self._token = CancelToken()
+
+        if result.value < 0:
+            if token.cancelled:
+                raise MiningCancelled("Mining cancelled")
+            raise Exception("Mining workers exited without finding a nonce")
+
+        blockContent['nonce'] = result.value
+        return hashMessage(blockContent)
+
+    def cancel(self):
+        if self.workers <= 1:
+            self._serial.cancel()
+        else:
+            self._token.cancel()
@@ -0,0 +1,123 @@
+import itertools
+import queue
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from miner import MiningCancelled
+
+class MiningScheduler:
+    """Runs mining jobs one at a time on a background thread, optionally triggering them automatically"""
+    def __init__(self, mineFn, pendingCount, miner=None, autoMinePending=None, autoMineInterval=None, maxJobs=100):
+        self.mineFn = mineFn
+        self.pendingCount = pendingCount
+        self.miner = miner
+        self.autoMinePending = autoMinePending
+        self.autoMineInterval = autoMineInterval
+        self.maxJobs = maxJobs
+        self.jobs = OrderedDict()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.finished = threading.Condition(self.lock)
+        self.ids = itertools.count(1)
+        self.queued = None
+        self.running = None
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='mining-scheduler', daemon=True)
+                self.thread.start()
+
+    def submit(self, trigger='manual'):
+        """Queue a mining job, or return the one already waiting to run"""
+        with self.lock:
+            if self.queued is not None:
+                return dict(self.queued)
+            job = {
+                'id': str(next(self.ids)),
+                'status': 'queued',
+                'trigger': trigger,
+                'created_at': datetime.now().isoformat(),
+                'started_at': None,
+                'finished_at': None,
+                'result': None,
+                'error': None
+            }
+            self.jobs[job['id']] = job
+            while len(self.jobs) > self.maxJobs:
+                self.jobs.popitem(last=False)
+            self.queued = job
+            self.queue.put(job)
+            job = dict(job)
+        self.start()
+        return job
+
+    def job(self, jobId):
+        with self.lock:
+            job = self.jobs.get(jobId)
+            return dict(job) if job else None
+
+    def wait(self, jobId, timeout=None):
+        """Block until the job has finished (or timeout) and return its record"""
+        with self.finished:
+            self.finished.wait_for(
+                lambda: self.jobs.get(jobId, {}).get('status') not in ('queued', 'running'),
+                timeout
+            )
+            job = self.jobs.get(jobId)
+            return dict(job) if job else None
+
+    def cancel(self, jobId):
+        with self.lock:
+            job = self.jobs.get(jobId)
+            if job is None:
+                return None
+            if job['status'] == 'queued':
+                job['status'] = 'cancelled'
+                job['finished_at'] = datetime.now().isoformat()
+                if self.queued is job:
+                    self.queued = None
+                self.finished.notify_all()
+            elif job['status'] == 'running' and self.miner is not None:
+                self.miner.cancel()
+            return dict(job)
+
+    def notify(self):
+        """Call after a transaction is accepted; starts a job once the pool reaches autoMinePending"""
+        if self.autoMinePending and self.pendingCount() >= self.autoMinePending:
+            self.submit('auto')
+
+    def _run(self):
+        while True:
+            try:
+                job = self.queue.get(timeout=self.autoMineInterval)
+            except queue.Empty:
+                if self.pendingCount():
+                    self.submit('timer')
+                continue
+
+            with self.lock:
+                if self.queued is job:
+                    self.queued = None
+                if job['status'] != 'queued':
+                    continue
+                job['status'] = 'running'
+                job['started_at'] = datetime.now().isoformat()
+                self.running = job
+                if self.miner is not None:
+                    self.miner.reset()
+
+            try:
+                result, status, error = self.mineFn(), 'done', None
+            except MiningCancelled as e:
+                result, status, error = None, 'cancelled', str(e)
+            except Exception as e:
+                result, status, error = None, 'failed', str(e)
+
+            with self.lock:
+                job.update(status=status, result=result, error=error,
+                           finished_at=datetime.now().isoformat())
+                self.running = None
+                self.finished.notify_all()
@@ -1,5 +1,6 @@
-import json
+from hash_utils import canonicalJson
 from keys import verifySign
+from transaction import Transaction
 
 def updateState(state, transaction):
     newState = state.copy()
@@ -7,10 +8,53 @@ def updateState(state, transaction):
         newState[key] = newState.get(key, 0) + transaction[key]
     return newState
 
-def isValid(state, signedTransaction):
-    transaction = signedTransaction['transaction']
-    publicKey = signedTransaction['publicKey']
-    signature = signedTransaction['signature']
+_MISSING = object()
+
+class StateOverlay:
+    """Journaled write layer over a balance dict: apply() is O(keys touched), commit() writes back, rollback() undoes"""
+    def __init__(self, base):
+        self.base = base
+        self.changes = {}
+        self.journal = []
+
+    def get(self, key, default=0):
+        value = self.changes.get(key, _MISSING)
+        if value is _MISSING:
+            return self.base.get(key, default)
+        return value
+
+    def apply(self, transaction):
+        for key in transaction:
+            self.journal.append((key, self.changes.get(key, _MISSING)))
+            self.changes[key] = self.get(key, 0) + transaction[key]
+
+    def checkpoint(self):
+        return len(self.journal)
+
+    def rollback(self, checkpoint=0):
+        while len(self.journal) > checkpoint:
+            key, previous = self.journal.pop()
+            if previous is _MISSING:
+                del self.changes[key]
+            else:
+                self.changes[key] = previous
+
+    def commit(self):
+        self.base.update(self.changes)
+        self.changes.clear()
+        self.journal.clear()
+        return self.base
+
+def isValid(state, signedTransaction, checkSignature=True):
+    """Check a signed transaction dict or Transaction against state; a Transaction reuses its signed message"""
+    if isinstance(signedTransaction, Transaction):
+        transaction = signedTransaction.transaction
+        publicKey = signedTransaction.publicKey
+        signature = signedTransaction.signature
+    else:
+        transaction = signedTransaction['transaction']
+        publicKey = signedTransaction['publicKey']
+        signature = signedTransaction['signature']
     
     if sum(transaction.values()) != 0:
         return False
@@ -19,8 +63,14 @@ def isValid(state, signedTransaction):
         if state.get(key, 0) + transaction[key] < 0:
             return False
         
-    message = json.dumps(transaction, sort_keys=True)
+    if not checkSignature:
+        return True
+    
+    if isinstance(signedTransaction, Transaction):
+        message = signedTransaction.message()
+    else:
+        message = canonicalJson(transaction)
     if not verifySign(message, signature, publicKey):
         return False
     
-    return True
\ No newline at end of file
+    return True
@@ -1,21 +1,159 @@
 import sqlite3
+import heapq
+import itertools
 import json
+import multiprocessing
 import os
+import threading
+import time
+import queue
+import struct
+import zlib
+from array import array
+from collections import OrderedDict
 from datetime import datetime
 from contextlib import contextmanager
 
+from hash_utils import hashMessage, canonicalJson
+from transaction import Transaction
+
 DATABASE_FILE = 'blockchain.db'
 BLOCKCHAIN_FILE = 'blockchain.json'
+BLOCK_LOG_FILE = 'blockchain.log'
 STATE_FILE = 'state.json'
 PENDING_FILE = 'pending_transactions.json'
+PENDING_LOG_FILE = 'pending_transactions.log'
+PENDING_COMPACT_THRESHOLD = 1000
+SNAPSHOT_FILE = 'snapshot.bin'
+SNAPSHOT_MAGIC = b'BCSNAP02'
+SNAPSHOT_HEADER = struct.Struct('<8sQQQ64s')
+TRANSACTION_INDEXES = {
+    'idx_transactions_sender': 'transactions (sender, id)',
+    'idx_transactions_receiver': 'transactions (receiver, id)',
+    'idx_transactions_block': 'transactions (block_index)',
+}
+STATS_WINDOW_BLOCKS = 100
+
+def transaction_rows(transactions):
+    """Yield (sender, receiver, amount, canonical json) for each transfer; Transactions reuse their signed message"""
+    for transaction in transactions:
+        if isinstance(transaction, Transaction):
+            tx = transaction.transaction
+        else:
+            tx = transaction.get('transaction')
+        if tx:
+            sender = None
+            receiver = None
+            amount = 0
+            
+            for user, value in tx.items():
+                if value < 0:
+                    sender = user
+                    amount = abs(value)
+                elif value > 0:
+                    receiver = user
+            
+            yield sender, receiver, amount, (transaction.message() if isinstance(transaction, Transaction)
+                                             else canonicalJson(tx))
+
+def balance_deltas(transactions):
+    """Net balance change per account over a block's transactions"""
+    deltas = {}
+    for transaction in transactions:
+        for user, value in transaction.get('transaction', {}).items():
+            deltas[user] = deltas.get(user, 0) + value
+    return deltas
+
+def parse_block_lines(lines):
+    """Reindex worker: parse raw block log lines into (block row, transaction rows, balance deltas)"""
+    parsed = []
+    for line in lines:
+        block = json.loads(line)
+        content = block['content']
+        timestamp = content.get('timestamp')
+        block_row = (content['index'], block['hash'], content.get('parentHash'),
+                     content['transactionCount'], content['nonce'], timestamp)
+        tx_rows = [
+            (content['index'], sender, receiver, amount, tx_json, timestamp)
+            for sender, receiver, amount, tx_json in transaction_rows(content['transactions'])
+        ]
+        parsed.append((block_row, tx_rows, balance_deltas(content['transactions'])))
+    return parsed
+
+def pending_record_json(record):
+    """Canonical journal line for one record; an add record reuses its Transaction's encoding"""
+    if record['op'] == 'add' and isinstance(record['tx'], Transaction):
+        return '{"id": %s, "op": "add", "tx": %s}' % (json.dumps(record['id']), record['tx'].json())
+    return canonicalJson(record)
+
+def block_hash_from_line(line):
+    """32-byte hash of a block log line; lines end with '"hash": "<hex>"}' because keys are sorted"""
+    try:
+        return bytes.fromhex(line[-67:-3].decode('ascii'))
+    except ValueError:
+        return bytes.fromhex(json.loads(line)['hash'])
+
+class ConnectionPool:
+    """Reusable SQLite connections in WAL mode with tuned pragmas"""
+    def __init__(self, database_file, max_idle=8, cache_size=-16000, cached_statements=256):
+        self.database_file = database_file
+        self.cache_size = cache_size
+        self.cached_statements = cached_statements
+        self.idle = queue.LifoQueue(maxsize=max_idle)
+    
+    def connect(self):
+        conn = sqlite3.connect(
+            self.database_file,
+            timeout=30,
+            check_same_thread=False,
+            cached_statements=self.cached_statements
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size={int(self.cache_size)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+    
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+    
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+    
+    def close_all(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
 
 class BlockchainStorage:
-    def __init__(self):
+    def __init__(self, database_file=DATABASE_FILE):
+        self.pool = ConnectionPool(database_file)
+        self.block_offsets = array('Q')
+        self.block_hashes = bytearray()
+        self.block_log_size = 0
+        self.pending_lock = threading.Lock()
+        # Live journal records (txid -> transaction), kept so compaction never re-reads the file
+        self.pending_records = OrderedDict()
+        self.pending_tombstones = 0
+        self.pending_compactor = None
+        # Records journaled while a compaction is writing its copy; None when none is running
+        self.pending_written = None
         self.init_database()
     
     def init_database(self):
         """Initialize SQLite database with required tables"""
-        with sqlite3.connect(DATABASE_FILE) as conn:
+        with self.get_db_connection() as conn:
             cursor = conn.cursor()
 
             cursor.execute('''
@@ -52,18 +190,81 @@ class BlockchainStorage:
                     FOREIGN KEY (block_index) REFERENCES blocks (block_index)
                 )
             ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS validation_checkpoints (
+                    height INTEGER PRIMARY KEY,
+                    block_hash TEXT NOT NULL,
+                    state_hash TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS account_balances (
+                    username TEXT NOT NULL,
+                    block_index INTEGER NOT NULL,
+                    balance INTEGER NOT NULL,
+                    PRIMARY KEY (username, block_index)
+                ) WITHOUT ROWID
+            ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS chain_stats (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    block_count INTEGER NOT NULL,
+                    transaction_count INTEGER NOT NULL,
+                    total_volume REAL NOT NULL
+                )
+            ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS block_stats (
+                    block_index INTEGER PRIMARY KEY,
+                    transaction_count INTEGER NOT NULL,
+                    volume REAL NOT NULL,
+                    cumulative_transactions INTEGER NOT NULL,
+                    timestamp TEXT
+                )
+            ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS reindex_progress (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    next_block INTEGER NOT NULL,
+                    difficulty INTEGER
+                )
+            ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS reindex_previous (
+                    block_index INTEGER PRIMARY KEY,
+                    timestamp TEXT,
+                    difficulty INTEGER
+                )
+            ''')
+
+            self._create_indexes(cursor)
+            
+            cursor.execute('SELECT 1 FROM chain_stats')
+            if cursor.fetchone() is None:
+                self._rebuild_stats(cursor)
             
             conn.commit()
     
+    def _create_indexes(self, cursor):
+        for name, definition in TRANSACTION_INDEXES.items():
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {definition}')
+    
     @contextmanager
     def get_db_connection(self):
-        """Context manager for database connections"""
-        conn = sqlite3.connect(DATABASE_FILE)
-        conn.row_factory = sqlite3.Row
+        """Context manager that checks a connection out of the pool"""
+        conn = self.pool.acquire()
         try:
             yield conn
         finally:
-            conn.close()
+            self.pool.release(conn)
     
     def save_user(self, username, private_key, public_key):
         """Save user to database"""
@@ -75,21 +276,36 @@ class BlockchainStorage:
             ''', (username, private_key, public_key))
             conn.commit()
     
-    def load_users(self):
-        """Load all users from database"""
+    def load_users(self, after_rowid=0):
+        """Load users from database, optionally only those added after a snapshot"""
         with self.get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT username, private_key, public_key FROM users')
+            cursor.execute('SELECT username, private_key, public_key FROM users WHERE rowid > ?', (after_rowid,))
             return {row['username']: {
                 'private_key': row['private_key'],
                 'public_key': row['public_key']
             } for row in cursor.fetchall()}
     
-    def save_block_metadata(self, block, difficulty):
-        """Save block metadata to database"""
+    def max_user_rowid(self):
+        """Highest users rowid, recorded in snapshots so later users can be loaded incrementally"""
+        with self.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT MAX(rowid) AS max_rowid FROM users')
+            return cursor.fetchone()['max_rowid'] or 0
+    
+    def save_block_metadata(self, block, difficulty, transactions=None):
+        """Save block metadata to database; saving the same block again replaces its rows.
+        
+        transactions, if given, are the block's transactions as Transaction objects so their
+        encodings are reused instead of encoding the block content again.
+        """
         with self.get_db_connection() as conn:
             cursor = conn.cursor()
             content = block['content']
+            timestamp = content.get('timestamp', datetime.now().isoformat())
+            rows = list(transaction_rows(content['transactions'] if transactions is None else transactions))
+            
+            cursor.execute('DELETE FROM transactions WHERE block_index = ?', (content['index'],))
 
             cursor.execute('''
                 INSERT OR REPLACE INTO blocks 
@@ -101,96 +317,586 @@ class BlockchainStorage:
                 content.get('parentHash'),
                 content['transactionCount'],
                 content['nonce'],
-                content.get('timestamp', datetime.now().isoformat()),
+                timestamp,
                 difficulty
             ))
 
-            for transaction in content['transactions']:
-                if transaction.get('transaction'):
-                    tx = transaction['transaction']
-                    sender = None
-                    receiver = None
-                    amount = 0
-                    
-                    for user, value in tx.items():
-                        if value < 0:
-                            sender = user
-                            amount = abs(value)
-                        elif value > 0:
-                            receiver = user
-                    
-                    cursor.execute('''
-                        INSERT INTO transactions 
-                        (block_index, sender, receiver, amount, transaction_hash, timestamp)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                    ''', (
-                        content['index'],
-                        sender,
-                        receiver,
-                        amount,
-                        json.dumps(tx, sort_keys=True),
-                        content.get('timestamp', datetime.now().isoformat())
-                    ))
+            cursor.executemany('''
+                INSERT INTO transactions 
+                (block_index, sender, receiver, amount, transaction_hash, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (
+                (content['index'], sender, receiver, amount, tx_json, timestamp)
+                for sender, receiver, amount, tx_json in rows
+            ))
             
+            self._save_block_balances(cursor, block)
+            self._save_block_stats(cursor, content, timestamp, rows)
             conn.commit()
     
-    def get_transaction_history(self, username=None, limit=50):
-        """Get transaction history"""
+    def _save_block_stats(self, cursor, content, timestamp, rows):
+        """Update block_stats and the chain_stats totals for one block from its transaction_rows, replacing any earlier save of it"""
+        index = content['index']
+        count = len(rows)
+        volume = sum(amount for _, _, amount, _ in rows)
+        
+        cursor.execute('SELECT transaction_count, volume FROM block_stats WHERE block_index = ?', (index,))
+        previous = cursor.fetchone()
+        cursor.execute('SELECT cumulative_transactions FROM block_stats WHERE block_index = ?', (index - 1,))
+        parent = cursor.fetchone()
+        cumulative = (parent['cumulative_transactions'] if parent else 0) + count
+        
+        cursor.execute('''
+            INSERT OR REPLACE INTO block_stats
+            (block_index, transaction_count, volume, cumulative_transactions, timestamp)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (index, count, volume, cumulative, timestamp))
+        
+        if previous:
+            cursor.execute('''
+                UPDATE chain_stats SET transaction_count = transaction_count + ?, total_volume = total_volume + ?
+                WHERE id = 1
+            ''', (count - previous['transaction_count'], volume - previous['volume']))
+        else:
+            cursor.execute('''
+                UPDATE chain_stats SET block_count = block_count + 1,
+                transaction_count = transaction_count + ?, total_volume = total_volume + ?
+                WHERE id = 1
+            ''', (count, volume))
+    
+    def _rebuild_stats(self, cursor):
+        cursor.execute('DELETE FROM block_stats')
+        cursor.execute('''
+            INSERT INTO block_stats (block_index, transaction_count, volume, cumulative_transactions, timestamp)
+            SELECT b.block_index, COUNT(t.id), COALESCE(SUM(t.amount), 0),
+                   SUM(COUNT(t.id)) OVER (ORDER BY b.block_index), b.timestamp
+            FROM blocks b LEFT JOIN transactions t ON t.block_index = b.block_index
+            GROUP BY b.block_index
+        ''')
+        cursor.execute('''
+            INSERT OR REPLACE INTO chain_stats (id, block_count, transaction_count, total_volume)
+            SELECT 1, COUNT(*), COALESCE(SUM(transaction_count), 0), COALESCE(SUM(volume), 0) FROM block_stats
+        ''')
+    
+    def rebuild_stats(self):
+        """Recompute block_stats and chain_stats from the blocks and transactions tables"""
         with self.get_db_connection() as conn:
             cursor = conn.cursor()
-            if username:
-                cursor.execute('''
-                    SELECT * FROM transactions 
-                    WHERE sender = ? OR receiver = ?
-                    ORDER BY id DESC LIMIT ?
-                ''', (username, username, limit))
-            else:
+            self._rebuild_stats(cursor)
+            conn.commit()
+    
+    def _save_block_balances(self, cursor, block):
+        """Record the balance after this block for every account it touches"""
+        index = block['content']['index']
+        rows = []
+        for username, delta in balance_deltas(block['content']['transactions']).items():
+            cursor.execute('''
+                SELECT balance FROM account_balances
+                WHERE username = ? AND block_index < ?
+                ORDER BY block_index DESC LIMIT 1
+            ''', (username, index))
+            row = cursor.fetchone()
+            rows.append((username, index, (row['balance'] if row else 0) + delta))
+        cursor.executemany('''
+            INSERT OR REPLACE INTO account_balances (username, block_index, balance)
+            VALUES (?, ?, ?)
+        ''', rows)
+    
+    def save_block_balances(self, blocks):
+        """Index balances for blocks saved before the balance table existed"""
+        with self.get_db_connection() as conn:
+            cursor = conn.cursor()
+            for block in blocks:
+                self._save_block_balances(cursor, block)
+            conn.commit()
+    
+    def balances_height(self):
+        """Highest block with indexed balances, or -1"""
+        with self.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT MAX(block_index) AS height FROM account_balances')
+            height = cursor.fetchone()['height']
+            return -1 if height is None else height
+    
+    def get_balance_at(self, username, height):
+        """Balance of an account after the block at height"""
+        return self.get_balances_at([username], height)[username]
+    
+    def get_balances_at(self, usernames, height):
+        """Balances after the block at height, for the given accounts or for every account if usernames is None"""
+        with self.get_db_connection() as conn:
+            cursor = conn.cursor()
+            if usernames is None:
+                # SQLite takes bare columns from the row holding the MAX
                 cursor.execute('''
-                    SELECT * FROM transactions 
-                    ORDER BY id DESC LIMIT ?
-                ''', (limit,))
+                    SELECT username, balance, MAX(block_index) FROM account_balances
+                    WHERE block_index <= ? GROUP BY username
+                ''', (height,))
+                return {row['username']: row['balance'] for row in cursor}
             
+            balances = {}
+            for username in usernames:
+                cursor.execute('''
+                    SELECT balance FROM account_balances
+                    WHERE username = ? AND block_index <= ?
+                    ORDER BY block_index DESC LIMIT 1
+                ''', (username, height))
+                row = cursor.fetchone()
+                balances[username] = row['balance'] if row else 0
+            return balances
+    
+    def _history_filters(self, before_id=None, after_id=None, from_block=None, to_block=None,
+                         since=None, until=None):
+        """WHERE clauses, their parameters and the id order for the history filters"""
+        filters = []
+        params = []
+        for clause, value in (
+            ('id < ?', before_id),
+            ('id > ?', after_id),
+            ('block_index >= ?', from_block),
+            ('block_index <= ?', to_block),
+            ('timestamp >= ?', since),
+            ('timestamp <= ?', until)
+        ):
+            if value is not None:
+                filters.append(clause)
+                params.append(value)
+        
+        order = 'ASC' if after_id is not None and before_id is None else 'DESC'
+        return filters, params, order
+    
+    def _history_query(self, username=None, limit=50, **filters):
+        """Build the keyset-paginated history query; newest first unless paging forward with after_id"""
+        filters, params, order = self._history_filters(**filters)
+        limit = -1 if limit is None else limit
+        
+        if username:
+            # Two index range scans merged, instead of a full scan for sender OR receiver
+            where = ''.join(f' AND {clause}' for clause in filters)
+            query = f'''
+                SELECT * FROM (
+                    SELECT * FROM transactions WHERE sender = ?{where} ORDER BY id {order} LIMIT ?
+                )
+                UNION
+                SELECT * FROM (
+                    SELECT * FROM transactions WHERE receiver = ?{where} ORDER BY id {order} LIMIT ?
+                )
+                ORDER BY id {order} LIMIT ?
+            '''
+            return query, [username, *params, limit, username, *params, limit, limit]
+        
+        where = f"WHERE {' AND '.join(filters)}" if filters else ''
+        query = f'''
+            SELECT * FROM transactions {where}
+            ORDER BY id {order} LIMIT ?
+        '''
+        return query, [*params, limit]
+    
+    def get_transaction_history(self, username=None, limit=50, **filters):
+        """Get a page of transaction history"""
+        query, params = self._history_query(username, limit, **filters)
+        with self.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
             return [dict(row) for row in cursor.fetchall()]
     
-    def get_blockchain_stats(self):
-        """Get blockchain statistics"""
+    def iter_transaction_history(self, username=None, limit=None, **filters):
+        """Yield transaction history rows straight from the cursor.
+        
+        For a user, the sender and receiver index scans are read in id order and merged here
+        rather than by a UNION, which would sort every matching row before returning the first.
+        """
+        if not username:
+            query, params = self._history_query(username, limit, **filters)
+            with self.get_db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(query, params)
+                for row in cursor:
+                    yield dict(row)
+            return
+        
+        filters, params, order = self._history_filters(**filters)
+        where = ''.join(f' AND {clause}' for clause in filters)
+        with self.get_db_connection() as conn:
+            sent = conn.execute(f'SELECT * FROM transactions WHERE sender = ?{where} ORDER BY id {order}',
+                                [username, *params])
+            # Self-transfers are already in the sender scan
+            received = conn.execute(
+                f'SELECT * FROM transactions WHERE receiver = ? AND sender IS NOT ?{where} ORDER BY id {order}',
+                [username, username, *params]
+            )
+            rows = heapq.merge(sent, received, key=lambda row: row['id'], reverse=order == 'DESC')
+            for row in itertools.islice(rows, limit):
+                yield dict(row)
+    
+    def reindex(self, difficulty=None, workers=None, batch_size=1000, resume=True, report=None,
+                default_difficulty=None):
+        """Rebuild blocks, transactions, balances and stats from the block log.
+        
+        Lines are parsed in a process pool and bulk-loaded with the transaction indexes dropped.
+        Each batch commits together with the next block to load, so an interrupted run resumes
+        from there. report(blocks, rows, elapsed) is called after every batch.
+        
+        Blocks mined without a timestamp in their content keep the timestamp already recorded
+        for them, and each block keeps its recorded difficulty unless difficulty is given.
+        Blocks with no recorded difficulty, such as after losing the database, get default_difficulty.
+        """
+        self.scan_block_log()
+        total = len(self.block_offsets)
+        
         with self.get_db_connection() as conn:
             cursor = conn.cursor()
-
-            cursor.execute('SELECT COUNT(*) as block_count FROM blocks')
-            block_count = cursor.fetchone()['block_count']
-
-            cursor.execute('SELECT COUNT(*) as tx_count FROM transactions')
-            tx_count = cursor.fetchone()['tx_count']
-
-            cursor.execute('SELECT SUM(amount) as total_volume FROM transactions')
-            total_volume = cursor.fetchone()['total_volume'] or 0
+            cursor.execute('SELECT next_block, difficulty FROM reindex_progress WHERE id = 1')
+            progress = cursor.fetchone()
+            if progress and resume:
+                start = progress['next_block']
+                if difficulty is None:
+                    difficulty = progress['difficulty']
+                balances = self.get_balances_at(None, start - 1) if start else {}
+            else:
+                start = 0
+                balances = {}
+                # An interrupted run already saved what the blocks table held before it started
+                if not progress:
+                    cursor.execute('DELETE FROM reindex_previous')
+                    cursor.execute('''
+                        INSERT INTO reindex_previous (block_index, timestamp, difficulty)
+                        SELECT block_index, timestamp, difficulty FROM blocks
+                    ''')
+                for table in ('blocks', 'transactions', 'account_balances', 'block_stats'):
+                    cursor.execute(f'DELETE FROM {table}')
+                cursor.execute('INSERT OR REPLACE INTO reindex_progress (id, next_block, difficulty) VALUES (1, 0, ?)',
+                               (difficulty,))
+            # Opening the database recreates the indexes, so drop them on resume too
+            for name in TRANSACTION_INDEXES:
+                cursor.execute(f'DROP INDEX IF EXISTS {name}')
+            conn.commit()
+            
+            cursor.execute('SELECT block_index, timestamp, difficulty FROM reindex_previous WHERE block_index >= ?',
+                           (start,))
+            previous = {row['block_index']: (row['timestamp'], row['difficulty']) for row in cursor}
+            
+            began = time.perf_counter()
+            rows = 0
+            batches = (
+                list(self.iter_block_lines(batch_start, min(batch_start + batch_size, total)))
+                for batch_start in range(start, total, batch_size)
+            )
+            with multiprocessing.Pool(workers) as pool:
+                for parsed in pool.imap(parse_block_lines, batches):
+                    block_rows = []
+                    tx_rows = []
+                    balance_rows = []
+                    for block_row, block_tx_rows, deltas in parsed:
+                        kept_timestamp, kept_difficulty = previous.get(block_row[0], (None, None))
+                        if block_row[5] is None and kept_timestamp is not None:
+                            block_row = block_row[:5] + (kept_timestamp,)
+                            block_tx_rows = [row[:5] + (kept_timestamp,) for row in block_tx_rows]
+                        if difficulty is not None:
+                            kept_difficulty = difficulty
+                        elif kept_difficulty is None:
+                            kept_difficulty = default_difficulty
+                        block_rows.append(block_row + (kept_difficulty,))
+                        tx_rows.extend(block_tx_rows)
+                        for username, delta in deltas.items():
+                            balances[username] = balances.get(username, 0) + delta
+                            balance_rows.append((username, block_row[0], balances[username]))
+                    
+                    cursor.executemany('''
+                        INSERT OR REPLACE INTO blocks
+                        (block_index, block_hash, parent_hash, transaction_count, nonce, timestamp, difficulty)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ''', block_rows)
+                    cursor.executemany('''
+                        INSERT INTO transactions
+                        (block_index, sender, receiver, amount, transaction_hash, timestamp)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', tx_rows)
+                    cursor.executemany('''
+                        INSERT OR REPLACE INTO account_balances (username, block_index, balance)
+                        VALUES (?, ?, ?)
+                    ''', balance_rows)
+                    start += len(parsed)
+                    cursor.execute('UPDATE reindex_progress SET next_block = ? WHERE id = 1', (start,))
+                    conn.commit()
+                    
+                    rows += len(block_rows) + len(tx_rows) + len(balance_rows)
+                    if report:
+                        report(start, rows, time.perf_counter() - began)
             
+            self._create_indexes(cursor)
+            self._rebuild_stats(cursor)
+            cursor.execute('DELETE FROM reindex_progress')
+            cursor.execute('DELETE FROM reindex_previous')
+            conn.commit()
+            return start, rows, time.perf_counter() - began
+    
+    def get_blockchain_stats(self, window=STATS_WINDOW_BLOCKS):
+        """Get blockchain statistics from the materialized totals, with throughput over the last window blocks"""
+        with self.get_db_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT block_count, transaction_count, total_volume FROM chain_stats WHERE id = 1')
+            stats = dict(cursor.fetchone())
+            
+            cursor.execute('SELECT * FROM block_stats ORDER BY block_index DESC LIMIT 1')
+            tip = cursor.fetchone()
+            throughput = None
+            if tip is not None:
+                cursor.execute('SELECT * FROM block_stats WHERE block_index = ?', (max(tip['block_index'] - window, 0),))
+                start = cursor.fetchone()
+                if start is not None and start['timestamp'] and tip['timestamp']:
+                    elapsed = (datetime.fromisoformat(tip['timestamp']) -
+                               datetime.fromisoformat(start['timestamp'])).total_seconds()
+                    if elapsed > 0:
+                        throughput = (tip['cumulative_transactions'] - start['cumulative_transactions']) / elapsed
+            
+            stats['last_block_transactions'] = tip['transaction_count'] if tip else 0
+            stats['throughput_window_blocks'] = window
+            stats['transactions_per_second'] = throughput
+            return stats
+    
+    def append_block(self, block):
+        """Append one block to the block log and fsync it"""
+        return self.append_blocks([block])
+    
+    def append_blocks(self, blocks):
+        """Append blocks to the block log as NDJSON lines, fsyncing once for the batch"""
+        try:
+            offsets = []
+            hashes = bytearray()
+            data = bytearray()
+            for block in blocks:
+                offsets.append(self.block_log_size + len(data))
+                hashes += bytes.fromhex(block['hash'])
+                data += json.dumps(block, sort_keys=True).encode('utf-8') + b'\n'
+            with open(BLOCK_LOG_FILE, 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            self.block_offsets.extend(offsets)
+            self.block_hashes += hashes
+            self.block_log_size += len(data)
+            return True
+        except Exception as e:
+            print(f"Error appending to block log: {e}")
+            return False
+    
+    def save_checkpoint(self, checkpoint, keep=5):
+        """Save a verified (height, block hash, state) checkpoint, keeping only the latest few"""
+        with self.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO validation_checkpoints (height, block_hash, state_hash, state)
+                VALUES (?, ?, ?, ?)
+            ''', (
+                checkpoint['height'],
+                checkpoint['blockHash'],
+                checkpoint['stateHash'],
+                json.dumps(checkpoint['state'], sort_keys=True)
+            ))
+            cursor.execute('''
+                DELETE FROM validation_checkpoints WHERE height NOT IN (
+                    SELECT height FROM validation_checkpoints ORDER BY height DESC LIMIT ?
+                )
+            ''', (keep,))
+            conn.commit()
+    
+    def load_latest_checkpoint(self, max_height=None):
+        """Load the highest validation checkpoint at or below max_height"""
+        with self.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM validation_checkpoints
+                WHERE ? IS NULL OR height <= ?
+                ORDER BY height DESC LIMIT 1
+            ''', (max_height, max_height))
+            row = cursor.fetchone()
+            if row is None:
+                return None
             return {
-                'block_count': block_count,
-                'transaction_count': tx_count,
-                'total_volume': total_volume
+                'height': row['height'],
+                'blockHash': row['block_hash'],
+                'stateHash': row['state_hash'],
+                'state': json.loads(row['state'])
             }
     
     def save_blockchain(self, blockchain):
-        """Save blockchain to file"""
+        """Append any blocks not yet in the block log"""
+        if len(blockchain) < len(self.block_offsets):
+            print("Error saving blockchain: chain is shorter than the block log")
+            return False
+        new_blocks = blockchain[len(self.block_offsets):]
+        if not new_blocks:
+            return True
+        return self.append_blocks(list(new_blocks))
+    
+    def scan_block_log(self, offsets=(), hashes=b'', start_offset=0):
+        """Index block offsets and hashes from start_offset without parsing block bodies, truncating a torn tail"""
+        self.migrate_legacy_blockchain()
+        self.block_offsets = array('Q', offsets)
+        self.block_hashes = bytearray(hashes)
+        self.block_log_size = start_offset
+        if not os.path.exists(BLOCK_LOG_FILE):
+            return 0
+        
+        if start_offset > os.path.getsize(BLOCK_LOG_FILE):
+            raise Exception(f"Block log is shorter than offset {start_offset}")
+        
+        scanned = array('Q')
+        scanned_hashes = bytearray()
+        with open(BLOCK_LOG_FILE, 'rb+') as f:
+            f.seek(start_offset)
+            offset = start_offset
+            last_line = None
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                if last_line is not None:
+                    scanned_hashes += block_hash_from_line(last_line)
+                scanned.append(offset)
+                offset += len(line)
+                last_line = line
+            
+            # Only the last complete line can be half-written by a crash during append,
+            # so parse it before trusting its hash
+            if last_line is not None:
+                try:
+                    scanned_hashes += bytes.fromhex(json.loads(last_line)['hash'])
+                except (ValueError, KeyError, TypeError):
+                    offset = scanned.pop()
+            
+            if offset != os.path.getsize(BLOCK_LOG_FILE):
+                print(f"Truncating torn block log tail at byte {offset}")
+                f.truncate(offset)
+                f.flush()
+                os.fsync(f.fileno())
+        
+        self.block_offsets.extend(scanned)
+        self.block_hashes += scanned_hashes
+        self.block_log_size = offset
+        return len(scanned)
+    
+    def block_size(self, index):
+        """Size of a block's log line in bytes"""
+        end = self.block_offsets[index + 1] if index + 1 < len(self.block_offsets) else self.block_log_size
+        return end - self.block_offsets[index]
+    
+    def block_hash(self, index):
+        return self.block_hashes[index * 32:(index + 1) * 32].hex()
+    
+    def read_block(self, index):
+        """Read one block body from the log by its offset"""
+        with open(BLOCK_LOG_FILE, 'rb') as f:
+            f.seek(self.block_offsets[index])
+            return json.loads(f.readline())
+    
+    def iter_block_lines(self, start=0, stop=None):
+        """Raw block log lines for blocks start..stop-1"""
+        stop = len(self.block_offsets) if stop is None else stop
+        if start >= stop:
+            return
+        with open(BLOCK_LOG_FILE, 'rb') as f:
+            f.seek(self.block_offsets[start])
+            for _ in range(start, stop):
+                yield f.readline()
+    
+    def iter_blocks(self, start=0):
+        """Read blocks sequentially from the log starting at index start"""
+        if start >= len(self.block_offsets):
+            return
+        with open(BLOCK_LOG_FILE, 'rb') as f:
+            f.seek(self.block_offsets[start])
+            for _ in range(start, len(self.block_offsets)):
+                yield json.loads(f.readline())
+    
+    def load_blockchain(self):
+        """Load the whole blockchain from the block log into a list"""
+        try:
+            self.scan_block_log()
+            return list(self.iter_blocks()) or None
+        except Exception as e:
+            print(f"Error loading blockchain: {e}")
+            return None
+    
+    def save_snapshot(self, height, tip_hash, state, users):
+        """Write a snapshot of state, users and block offsets/hashes at height, for fast startup"""
         try:
-            with open(BLOCKCHAIN_FILE, 'w') as f:
-                json.dump(blockchain, f, indent=2, sort_keys=True)
+            sections = [
+                json.dumps(state, sort_keys=True).encode('utf-8'),
+                json.dumps(users, sort_keys=True).encode('utf-8'),
+                self.block_offsets[:height + 1].tobytes(),
+                bytes(self.block_hashes[:(height + 1) * 32])
+            ]
+            log_size = (self.block_offsets[height + 1] if height + 1 < len(self.block_offsets)
+                        else self.block_log_size)
+            header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, height, log_size, self.max_user_rowid(),
+                                          tip_hash.encode('ascii'))
+            
+            temp_file = SNAPSHOT_FILE + '.tmp'
+            with open(temp_file, 'wb') as f:
+                f.write(header)
+                for section in sections:
+                    data = zlib.compress(section, 1)
+                    f.write(struct.pack('<Q', len(data)))
+                    f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, SNAPSHOT_FILE)
             return True
         except Exception as e:
-            print(f"Error saving blockchain: {e}")
+            print(f"Error saving snapshot: {e}")
             return False
     
-    def load_blockchain(self):
-        """Load blockchain from file"""
+    def load_snapshot(self):
+        """Load the snapshot written by save_snapshot, or None"""
         try:
-            if os.path.exists(BLOCKCHAIN_FILE):
-                with open(BLOCKCHAIN_FILE, 'r') as f:
-                    return json.load(f)
+            if not os.path.exists(SNAPSHOT_FILE):
+                return None
+            with open(SNAPSHOT_FILE, 'rb') as f:
+                magic, height, log_size, users_rowid, tip_hash = SNAPSHOT_HEADER.unpack(
+                    f.read(SNAPSHOT_HEADER.size))
+                if magic != SNAPSHOT_MAGIC:
+                    raise Exception("unrecognised snapshot format")
+                sections = []
+                for _ in range(4):
+                    length, = struct.unpack('<Q', f.read(8))
+                    sections.append(zlib.decompress(f.read(length)))
+            return {
+                'height': height,
+                'log_size': log_size,
+                'users_rowid': users_rowid,
+                'tip_hash': tip_hash.decode('ascii'),
+                'state': json.loads(sections[0]),
+                'users': json.loads(sections[1]),
+                'offsets': array('Q', sections[2]),
+                'hashes': sections[3]
+            }
         except Exception as e:
-            print(f"Error loading blockchain: {e}")
-        return None
+            print(f"Error loading snapshot: {e}")
+            return None
+    
+    def migrate_legacy_blockchain(self):
+        """Convert a legacy blockchain.json into the block log, once"""
+        if os.path.exists(BLOCK_LOG_FILE) or not os.path.exists(BLOCKCHAIN_FILE):
+            return False
+        try:
+            with open(BLOCKCHAIN_FILE, 'r') as f:
+                blockchain = json.load(f)
+            
+            temp_file = BLOCK_LOG_FILE + '.tmp'
+            with open(temp_file, 'wb') as f:
+                for block in blockchain:
+                    f.write(json.dumps(block, sort_keys=True).encode('utf-8') + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, BLOCK_LOG_FILE)
+            os.replace(BLOCKCHAIN_FILE, BLOCKCHAIN_FILE + '.migrated')
+            print(f"Migrated {len(blockchain)} blocks from {BLOCKCHAIN_FILE} to {BLOCK_LOG_FILE}")
+            return True
+        except Exception as e:
+            print(f"Error migrating blockchain: {e}")
+            return False
     
     def save_state(self, state):
         """Save current state to file"""
@@ -212,22 +918,155 @@ class BlockchainStorage:
             print(f"Error loading state: {e}")
         return None
     
+    def _write_pending_records(self, records, mode='ab'):
+        data = b''.join(pending_record_json(record).encode('utf-8') + b'\n' for record in records)
+        with open(PENDING_LOG_FILE, mode) as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if self.pending_written is not None:
+            self.pending_written.extend(records)
+    
+    def append_pending(self, transaction, txid=None):
+        """Journal one accepted pending transaction"""
+        if txid is None:
+            txid = hashMessage(transaction)
+        return self.append_pending_batch([(txid, transaction)])
+    
+    def append_pending_batch(self, entries):
+        """Journal (txid, transaction) pairs with a single write and fsync"""
+        try:
+            with self.pending_lock:
+                self._write_pending_records([{'op': 'add', 'id': txid, 'tx': tx} for txid, tx in entries])
+                for txid, tx in entries:
+                    self.pending_records[txid] = tx
+            return True
+        except Exception as e:
+            print(f"Error journaling pending transactions: {e}")
+            return False
+    
+    def remove_pending(self, txids):
+        """Journal tombstones for mined transaction ids and compact the journal in the background when it gets sparse"""
+        try:
+            with self.pending_lock:
+                self._write_pending_records([{'op': 'del', 'id': txid} for txid in txids])
+                for txid in txids:
+                    self.pending_records.pop(txid, None)
+                self.pending_tombstones += len(txids)
+                needs_compaction = (self.pending_tombstones >= PENDING_COMPACT_THRESHOLD
+                                    and self.pending_tombstones > len(self.pending_records))
+                if needs_compaction and not (self.pending_compactor and self.pending_compactor.is_alive()):
+                    self.pending_compactor = threading.Thread(target=self.compact_pending, daemon=True)
+                    self.pending_compactor.start()
+            return True
+        except Exception as e:
+            print(f"Error journaling mined transactions: {e}")
+            return False
+    
+    def _replay_pending(self):
+        """Replay the pending journal into an ordered id -> transaction map, truncating a torn tail"""
+        pending = OrderedDict()
+        tombstones = 0
+        if not os.path.exists(PENDING_LOG_FILE):
+            return pending, tombstones
+        
+        with open(PENDING_LOG_FILE, 'rb+') as f:
+            offset = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if record['op'] == 'add':
+                    pending[record['id']] = record['tx']
+                elif pending.pop(record['id'], None) is not None:
+                    tombstones += 1
+                offset += len(line)
+            
+            if offset != os.path.getsize(PENDING_LOG_FILE):
+                print(f"Truncating torn pending journal tail at byte {offset}")
+                f.truncate(offset)
+                f.flush()
+                os.fsync(f.fileno())
+        return pending, tombstones
+    
+    def _rewrite_pending(self, pending_transactions):
+        temp_file = PENDING_LOG_FILE + '.tmp'
+        records = [{'op': 'add', 'id': tx.txid() if isinstance(tx, Transaction) else hashMessage(tx), 'tx': tx}
+                   for tx in pending_transactions]
+        data = b''.join(pending_record_json(record).encode('utf-8') + b'\n' for record in records)
+        with open(temp_file, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, PENDING_LOG_FILE)
+        self.pending_records = OrderedDict((record['id'], record['tx']) for record in records)
+        self.pending_tombstones = 0
+        # A compaction still writing its copy would now swap in stale records
+        self.pending_written = None
+    
+    def compact_pending(self):
+        """Rewrite the pending journal with only live transactions.
+        
+        The live records are copied under pending_lock, but encoded and written outside it, so
+        appends are not held up. Records journaled in the meantime are appended to the new file
+        under the lock just before it replaces the journal.
+        """
+        temp_file = PENDING_LOG_FILE + '.compact'
+        try:
+            with self.pending_lock:
+                live = list(self.pending_records.items())
+                self.pending_written = written = []
+            
+            with open(temp_file, 'wb') as f:
+                f.write(b''.join(
+                    pending_record_json({'op': 'add', 'id': txid, 'tx': tx}).encode('utf-8') + b'\n'
+                    for txid, tx in live
+                ))
+                
+                with self.pending_lock:
+                    if self.pending_written is not written:
+                        f.close()
+                        os.remove(temp_file)
+                        return False
+                    f.write(b''.join(pending_record_json(record).encode('utf-8') + b'\n' for record in written))
+                    f.flush()
+                    os.fsync(f.fileno())
+                    os.replace(temp_file, PENDING_LOG_FILE)
+                    self.pending_tombstones = sum(1 for record in written if record['op'] == 'del')
+                    self.pending_written = None
+            return True
+        except Exception as e:
+            print(f"Error compacting pending journal: {e}")
+            with self.pending_lock:
+                self.pending_written = None
+            return False
+    
     def save_pending_transactions(self, pending_transactions):
-        """Save pending transactions to file"""
+        """Rewrite the pending journal as a compacted snapshot of pending_transactions"""
         try:
-            with open(PENDING_FILE, 'w') as f:
-                json.dump(pending_transactions, f, indent=2, sort_keys=True)
+            with self.pending_lock:
+                self._rewrite_pending(pending_transactions)
             return True
         except Exception as e:
             print(f"Error saving pending transactions: {e}")
             return False
     
     def load_pending_transactions(self):
-        """Load pending transactions from file"""
+        """Load pending transactions by replaying the journal"""
         try:
-            if os.path.exists(PENDING_FILE):
-                with open(PENDING_FILE, 'r') as f:
-                    return json.load(f)
+            with self.pending_lock:
+                if not os.path.exists(PENDING_LOG_FILE) and os.path.exists(PENDING_FILE):
+                    with open(PENDING_FILE, 'r') as f:
+                        self._rewrite_pending(json.load(f))
+                    os.replace(PENDING_FILE, PENDING_FILE + '.migrated')
+                
+                pending, tombstones = self._replay_pending()
+                self.pending_records = pending
+                self.pending_tombstones = tombstones
+                return list(pending.values())
         except Exception as e:
             print(f"Error loading pending transactions: {e}")
         return []
@@ -240,10 +1079,9 @@ class BlockchainStorage:
             
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             backup_files = {
-                f'{backup_dir}/blockchain_{timestamp}.json': BLOCKCHAIN_FILE,
+                f'{backup_dir}/blockchain_{timestamp}.log': BLOCK_LOG_FILE,
                 f'{backup_dir}/state_{timestamp}.json': STATE_FILE,
-                f'{backup_dir}/pending_{timestamp}.json': PENDING_FILE,
-                f'{backup_dir}/database_{timestamp}.db': DATABASE_FILE
+                f'{backup_dir}/pending_{timestamp}.log': PENDING_LOG_FILE
             }
             
             for backup_file, original_file in backup_files.items():
@@ -251,6 +1089,14 @@ class BlockchainStorage:
                     import shutil
                     shutil.copy2(original_file, backup_file)
             
+            # The WAL may hold committed pages, so copy through the backup API
+            with self.get_db_connection() as conn:
+                backup_conn = sqlite3.connect(f'{backup_dir}/database_{timestamp}.db')
+                try:
+                    conn.backup(backup_conn)
+                finally:
+                    backup_conn.close()
+            
             return True
         except Exception as e:
             print(f"Error creating backup: {e}")
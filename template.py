@@ -0,0 +1,131 @@
+import heapq
+import itertools
+
+# Stale heap entries allowed beyond the live ones before a heap is rebuilt
+HEAP_SLACK = 64
+
+class BlockTemplate:
+    """Bounded, priority-ordered selection of mempool transactions for the next block, kept up to date on arrival"""
+    def __init__(self, mempool, maxTransactions=1000, maxBytes=None, priority='arrival'):
+        if priority not in ('arrival', 'fee'):
+            raise ValueError(f"Unknown block priority: {priority}")
+        self.mempool = mempool
+        self.maxTransactions = maxTransactions
+        self.maxBytes = maxBytes
+        self.priority = priority
+        self.sequence = itertools.count()
+        self.selected = {}
+        self.selectedBytes = 0
+        self.worst = []
+        self.backlog = []
+        self.parked = {}
+
+    def _key(self, signedTransaction):
+        if self.priority == 'fee':
+            return (-(signedTransaction.fee or 0), next(self.sequence))
+        return (next(self.sequence),)
+
+    def _fits(self, size):
+        if len(self.selected) >= self.maxTransactions:
+            return False
+        return self.maxBytes is None or self.selectedBytes + size <= self.maxBytes
+
+    def _select(self, txid, key, size):
+        self.selected[txid] = (key, size)
+        self.selectedBytes += size
+        heapq.heappush(self.worst, (tuple(-part for part in key), txid))
+
+    def _unselect(self, txid):
+        key, size = self.selected.pop(txid)
+        self.selectedBytes -= size
+        self._compact()
+        return key, size
+
+    def _compact(self):
+        """Rebuild the heaps once entries for mined, parked or displaced transactions outnumber the live ones"""
+        if len(self.worst) > 2 * len(self.selected) + HEAP_SLACK:
+            self.worst = [(tuple(-part for part in key), txid) for txid, (key, _) in self.selected.items()]
+            heapq.heapify(self.worst)
+        if len(self.backlog) > 2 * max(len(self.mempool) - len(self.selected), 0) + HEAP_SLACK:
+            self.backlog = [
+                entry for entry in self.backlog
+                if entry[2] in self.mempool and entry[2] not in self.selected and entry[2] not in self.parked
+            ]
+            heapq.heapify(self.backlog)
+
+    def _worstSelected(self):
+        while self.worst:
+            negatedKey, txid = self.worst[0]
+            if txid in self.selected and self.selected[txid][0] == tuple(-part for part in negatedKey):
+                return txid
+            heapq.heappop(self.worst)
+        return None
+
+    def add(self, txid, signedTransaction):
+        """Offer a newly accepted mempool Transaction; it displaces the lowest-priority entry if it ranks higher"""
+        return self._offer(txid, self._key(signedTransaction), len(signedTransaction.json()))
+
+    def _offer(self, txid, key, size):
+        if self.maxBytes is not None and size > self.maxBytes:
+            return False
+        while not self._fits(size):
+            worstId = self._worstSelected()
+            if worstId is None or self.selected[worstId][0] < key:
+                heapq.heappush(self.backlog, (key, size, txid))
+                self.fill()
+                return txid in self.selected
+            worstKey, worstSize = self._unselect(worstId)
+            heapq.heappush(self.backlog, (worstKey, worstSize, worstId))
+        self._select(txid, key, size)
+        return True
+
+    def discard(self, txid):
+        """Drop a mined transaction from the template; heap entries are skipped lazily until compacted"""
+        self.parked.pop(txid, None)
+        if txid in self.selected:
+            self._unselect(txid)
+
+    def park(self, txid):
+        """Take a transaction that no longer applies out of the template until unpark() or rebuild()"""
+        if txid in self.selected:
+            self.parked[txid] = self._unselect(txid)
+        elif txid in self.mempool:
+            signedTransaction = self.mempool.get(txid)
+            self.parked[txid] = (self._key(signedTransaction), len(signedTransaction.json()))
+
+    def unpark(self, txids):
+        """Offer parked transactions again at their original priority, e.g. once a block has moved balances"""
+        for txid in txids:
+            entry = self.parked.pop(txid, None)
+            if entry is not None and txid in self.mempool:
+                self._offer(txid, *entry)
+
+    def fill(self):
+        """Top the template up from the backlog in priority order"""
+        while self.backlog:
+            key, size, txid = self.backlog[0]
+            if txid not in self.mempool or txid in self.selected or txid in self.parked:
+                heapq.heappop(self.backlog)
+                continue
+            if not self._fits(size):
+                break
+            heapq.heappop(self.backlog)
+            self._select(txid, key, size)
+
+    def rebuild(self):
+        """Recompute the template from the whole mempool"""
+        self.selected = {}
+        self.selectedBytes = 0
+        self.worst = []
+        self.backlog = []
+        self.parked = {}
+        for txid, signedTransaction in self.mempool.items():
+            self.add(txid, signedTransaction)
+
+    def transactions(self):
+        """(txid, Transaction) pairs in priority order"""
+        ordered = sorted(self.selected.items(), key=lambda item: item[1][0])
+        return [(txid, self.mempool.get(txid)) for txid, _ in ordered]
+
+    def __len__(self):
+        return len(self.selected)
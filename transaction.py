@@ -1,11 +1,13 @@
-import random, json
+import random
+import sys
+from hash_utils import hashMessage, canonicalJson
 from user import getPrivateKey, getPublicKey
 from keys import signMessage
 
 def makeTransaction(sender, receiver, maxValue=3):
     value = random.randint(1, maxValue)
     transaction = {sender: -value, receiver: value}
-    message = json.dumps(transaction, sort_keys=True)
+    message = canonicalJson(transaction)
     
     priv_key = getPrivateKey(sender)
     pub_key = getPublicKey(sender)
@@ -17,3 +19,85 @@ def makeTransaction(sender, receiver, maxValue=3):
         'signature': signature
     }
 
+
+class Transaction:
+    """Signed transaction held in slots instead of nested dicts.
+
+    changes is a flat (account, delta, account, delta, ...) tuple. toDict() and fromDict()
+    convert losslessly at the API, hashing and storage boundaries; keys outside the known
+    fields, or optional fields explicitly set to None, are kept in extra.
+
+    A Transaction is not changed once built, so its signed message, canonical encoding and
+    hash are each computed once and reused for validation, template sizing, the pending
+    journal, the SQLite rows and the merkle leaves.
+    """
+    __slots__ = ('changes', 'publicKey', 'signature', 'timestamp', 'fee', 'extra', '_message', '_json', '_hash')
+    OPTIONAL_FIELDS = ('timestamp', 'fee')
+
+    def __init__(self, changes, publicKey, signature, timestamp=None, fee=None, extra=None):
+        self.changes = tuple(changes)
+        self.publicKey = publicKey
+        self.signature = signature
+        self.timestamp = timestamp
+        self.fee = fee
+        self.extra = extra
+        self._message = None
+        self._json = None
+        self._hash = None
+
+    @classmethod
+    def fromDict(cls, signedTransaction):
+        changes = []
+        for account, delta in signedTransaction['transaction'].items():
+            # Account names repeat across millions of transactions; keep one copy of each
+            changes += (sys.intern(account), delta)
+        extra = {
+            key: value for key, value in signedTransaction.items()
+            if key not in ('transaction', 'publicKey', 'signature', *cls.OPTIONAL_FIELDS)
+            or (key in cls.OPTIONAL_FIELDS and value is None)
+        }
+        return cls(changes, signedTransaction['publicKey'], signedTransaction['signature'],
+                   signedTransaction.get('timestamp'), signedTransaction.get('fee'), extra or None)
+
+    @property
+    def transaction(self):
+        return dict(zip(self.changes[::2], self.changes[1::2]))
+
+    def toDict(self):
+        signedTransaction = {
+            'transaction': self.transaction,
+            'publicKey': self.publicKey,
+            'signature': self.signature
+        }
+        if self.timestamp is not None:
+            signedTransaction['timestamp'] = self.timestamp
+        if self.fee is not None:
+            signedTransaction['fee'] = self.fee
+        if self.extra:
+            signedTransaction.update(self.extra)
+        return signedTransaction
+
+    def message(self):
+        """canonicalJson(self.transaction), the signed message, computed once"""
+        if self._message is None:
+            self._message = canonicalJson(self.transaction)
+        return self._message
+
+    def json(self):
+        """canonicalJson(self.toDict()), computed once"""
+        if self._json is None:
+            self._json = canonicalJson(self.toDict())
+        return self._json
+
+    def txid(self):
+        """hashMessage(self.toDict()), computed once"""
+        if self._hash is None:
+            self._hash = hashMessage(self.json())
+        return self._hash
+
+    def __eq__(self, other):
+        if not isinstance(other, Transaction):
+            return NotImplemented
+        return self.toDict() == other.toDict()
+
+    __hash__ = None
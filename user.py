@@ -1,6 +1,7 @@
 import hashlib
 
 user_db = {}
+public_key_index = {}
 
 def generateKeys(name):
     priv_key = f"{name}_private"
@@ -9,10 +10,16 @@ def generateKeys(name):
         'private_key': priv_key,
         'public_key': pub_key
     }
+    public_key_index[pub_key] = priv_key
     return priv_key, pub_key
 
+def loadUsers(users):
+    user_db.update(users)
+    for user_info in users.values():
+        public_key_index[user_info['public_key']] = user_info['private_key']
+
 def getPublicKey(name):
     return user_db[name]['public_key']
 
 def getPrivateKey(name):
-    return user_db[name]['private_key']
\ No newline at end of file
+    return user_db[name]['private_key']